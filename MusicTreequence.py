@@ -1,98 +1,114 @@
 import io
+import os
+import re
+import sys
+import time
+import runpy
+import socket
+import struct
+import wave
+import threading
+import asyncio
+import argparse
+import importlib
+import json
+import concurrent.futures
+import traceback
 import random
 import string
+import heapq
+import shutil
+import hashlib
+import tempfile
+import weakref
+import itertools
+import contextvars
 import collections
+import collections.abc
+from operator import itemgetter
+from functools import lru_cache, wraps
 from contextlib import contextmanager
 import numpy as np
-from copy import deepcopy
-
-
-MIDI_pitch = {
-    ",,,C": 0, ",,,,B#": 0, "C3": 0, "B#4": 0, ",,,C#": 1, ",,,Db": 1, "C#3": 1, "Db3": 1, ",,,D": 2, "D3": 2,
-    ",,,D#": 3, ",,,Eb": 3, "D#3": 3, "Eb3": 3, ",,,E": 4, ",,,Fb": 4, "E3": 4, "Fb3": 4, ",,,F": 5, ",,,E#": 5,
-    "F3": 5, "E#3": 5, ",,,F#": 6, ",,,Gb": 6, "F#3": 6, "Gb3": 6, ",,,G": 7, "G3": 7, ",,,G#": 8, ",,,Ab": 8,
-    "G#3": 8, "Ab3": 8, ",,,A": 9, "A3": 9, ",,,A#": 10, ",,,Bb": 10, "A#3": 10, "Bb3": 10, ",,,B": 11,
-    ",,Cb": 11, "B3": 11, "Cb2": 11, ",,C": 12, ",,,B#": 12, "C2": 12, "B#3": 12, ",,C#": 13, ",,Db": 13,
-    "C#2": 13, "Db2": 13, ",,D": 14, "D2": 14, ",,D#": 15, ",,Eb": 15, "D#2": 15, "Eb2": 15, ",,E": 16,
-    ",,Fb": 16, "E2": 16, "Fb2": 16, ",,F": 17, ",,E#": 17, "F2": 17, "E#2": 17, ",,F#": 18, ",,Gb": 18,
-    "F#2": 18, "Gb2": 18, ",,G": 19, "G2": 19, ",,G#": 20, ",,Ab": 20, "G#2": 20, "Ab2": 20, ",,A": 21,
-    "A2": 21, ",,A#": 22, ",,Bb": 22, "A#2": 22, "Bb2": 22, ",,B": 23, ",Cb": 23, "B2": 23, "Cb1": 23, ",C": 24,
-    ",,B#": 24, "C1": 24, "B#2": 24, ",C#": 25, ",Db": 25, "C#1": 25, "Db1": 25, ",D": 26, "D1": 26, ",D#": 27,
-    ",Eb": 27, "D#1": 27, "Eb1": 27, ",E": 28, ",Fb": 28, "E1": 28, "Fb1": 28, ",F": 29, ",E#": 29, "F1": 29,
-    "E#1": 29, ",F#": 30, ",Gb": 30, "F#1": 30, "Gb1": 30, ",G": 31, "G1": 31, ",G#": 32, ",Ab": 32, "G#1": 32,
-    "Ab1": 32, ",A": 33, "A1": 33, ",A#": 34, ",Bb": 34, "A#1": 34, "Bb1": 34, ",B": 35, "Cb": 35, "B1": 35,
-    "Cb0": 35, "C": 36, ",B#": 36, "C0": 36, "B#1": 36, "C#": 37, "Db": 37, "C#0": 37, "Db0": 37, "D": 38,
-    "D0": 38, "D#": 39, "Eb": 39, "D#0": 39, "Eb0": 39, "E": 40, "Fb": 40, "E0": 40, "Fb0": 40, "F": 41,
-    "E#": 41, "F0": 41, "E#0": 41, "F#": 42, "Gb": 42, "F#0": 42, "Gb0": 42, "G": 43, "G0": 43, "G#": 44,
-    "Ab": 44, "G#0": 44, "Ab0": 44, "A": 45, "A0": 45, "A#": 46, "Bb": 46, "A#0": 46, "Bb0": 46, "B": 47,
-    "cb": 47, "B0": 47, "cb0": 47, "c": 48, "B#": 48, "c0": 48, "B#0": 48, "c#": 49, "db": 49, "c#0": 49,
-    "db0": 49, "d": 50, "d0": 50, "d#": 51, "eb": 51, "d#0": 51, "eb0": 51, "e": 52, "fb": 52, "e0": 52,
-    "fb0": 52, "f": 53, "e#": 53, "f0": 53, "e#0": 53, "f#": 54, "gb": 54, "f#0": 54, "gb0": 54, "g": 55,
-    "g0": 55, "g#": 56, "ab": 56, "g#0": 56, "ab0": 56, "a": 57, "a0": 57, "a#": 58, "bb": 58, "a#0": 58,
-    "bb0": 58, "b": 59, "cb'": 59, "b0": 59, "cb1": 59, "c'": 60, "b#": 60, "c1": 60, "b#0": 60, "c#'": 61,
-    "db'": 61, "c#1": 61, "db1": 61, "d'": 62, "d1": 62, "d#'": 63, "eb'": 63, "d#1": 63, "eb1": 63, "e'": 64,
-    "fb'": 64, "e1": 64, "fb1": 64, "f'": 65, "e#'": 65, "f1": 65, "e#1": 65, "f#'": 66, "gb'": 66, "f#1": 66,
-    "gb1": 66, "g'": 67, "g1": 67, "g#'": 68, "ab'": 68, "g#1": 68, "ab1": 68, "a'": 69, "a1": 69, "a#'": 70,
-    "bb'": 70, "a#1": 70, "bb1": 70, "b'": 71, "cb''": 71, "b1": 71, "cb2": 71, "c''": 72, "b#'": 72, "c2": 72,
-    "b#1": 72, "c#''": 73, "db''": 73, "c#2": 73, "db2": 73, "d''": 74, "d2": 74, "d#''": 75, "eb''": 75,
-    "d#2": 75, "eb2": 75, "e''": 76, "fb''": 76, "e2": 76, "fb2": 76, "f''": 77, "e#''": 77, "f2": 77,
-    "e#2": 77, "f#''": 78, "gb''": 78, "f#2": 78, "gb2": 78, "g''": 79, "g2": 79, "g#''": 80, "ab''": 80,
-    "g#2": 80, "ab2": 80, "a''": 81, "a2": 81, "a#''": 82, "bb''": 82, "a#2": 82, "bb2": 82, "b''": 83,
-    "cb'''": 83, "b2": 83, "cb3": 83, "c'''": 84, "b#''": 84, "c3": 84, "b#2": 84, "c#'''": 85, "db'''": 85,
-    "c#3": 85, "db3": 85, "d'''": 86, "d3": 86, "d#'''": 87, "eb'''": 87, "d#3": 87, "eb3": 87, "e'''": 88,
-    "fb'''": 88, "e3": 88, "fb3": 88, "f'''": 89, "e#'''": 89, "f3": 89, "e#3": 89, "f#'''": 90, "gb'''": 90,
-    "f#3": 90, "gb3": 90, "g'''": 91, "g3": 91, "g#'''": 92, "ab'''": 92, "g#3": 92, "ab3": 92, "a'''": 93,
-    "a3": 93, "a#'''": 94, "bb'''": 94, "a#3": 94, "bb3": 94, "b'''": 95, "cb''''": 95, "b3": 95, "cb4": 95,
-    "c''''": 96, "b#'''": 96, "c4": 96, "b#3": 96, "c#''''": 97, "db''''": 97, "c#4": 97, "db4": 97,
-    "d''''": 98, "d4": 98, "d#''''": 99, "eb''''": 99, "d#4": 99, "eb4": 99, "e''''": 100, "fb''''": 100,
-    "e4": 100, "fb4": 100, "f''''": 101, "e#''''": 101, "f4": 101, "e#4": 101, "f#''''": 102, "gb''''": 102,
-    "f#4": 102, "gb4": 102, "g''''": 103, "g4": 103, "g#''''": 104, "ab''''": 104, "g#4": 104, "ab4": 104,
-    "a''''": 105, "a4": 105, "a#''''": 106, "bb''''": 106, "a#4": 106, "bb4": 106, "b''''": 107, "cb'''''": 107,
-    "b4": 107, "cb5": 107, "c'''''": 108, "b#''''": 108, "c5": 108, "b#4": 108, "c#'''''": 109, "db'''''": 109,
-    "c#5": 109, "db5": 109, "d'''''": 110, "d5": 110, "d#'''''": 111, "eb'''''": 111, "d#5": 111, "eb5": 111,
-    "e'''''": 112, "fb'''''": 112, "e5": 112, "fb5": 112, "f'''''": 113, "e#'''''": 113, "f5": 113, "e#5": 113,
-    "f#'''''": 114, "gb'''''": 114, "f#5": 114, "gb5": 114, "g'''''": 115, "g5": 115, "g#'''''": 116,
-    "ab'''''": 116, "g#5": 116, "ab5": 116, "a'''''": 117, "a5": 117, "a#'''''": 118, "bb'''''": 118,
-    "a#5": 118, "bb5": 118, "b'''''": 119, "cb''''''": 119, "b5": 119, "cb6": 119, "c''''''": 120,
-    "b#'''''": 120, "c6": 120, "b#5": 120, "c#''''''": 121, "db''''''": 121, "c#6": 121, "db6": 121,
-    "d''''''": 122, "d6": 122, "d#''''''": 123, "eb''''''": 123, "d#6": 123, "eb6": 123, "e''''''": 124,
-    "fb''''''": 124, "e6": 124, "fb6": 124, "f''''''": 125, "e#''''''": 125, "f6": 125, "e#6": 125,
-    "f#''''''": 126, "gb''''''": 126, "f#6": 126, "gb6": 126, "g''''''": 127, "g6": 127
-}
+from copy import copy, deepcopy
+
+
+# pitch spellings: Helmholtz notation (",C" = 24, "C" = 36, "c" = 48, "c'" = 60) or scientific octave numbers counted
+# in the same direction ("C1" = 24, "c0" = 48, "c1" = 60) with an optional accidental ("#" or "b") after the letter
+pitch_spelling = re.compile(r"(?P<commas>,*)(?P<letter>[A-Ga-g])(?P<accidental>[#b]?)(?P<apostrophes>'*)"
+                            r"(?P<number>\d*)")
+pitch_class = {"c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+accidental_shift = {"": 0, "#": 1, "b": -1}
+MIN_PITCH = 0
+MAX_PITCH = 127
 
 
 def min_pitch():
-    return min(MIDI_pitch.values())
+    return MIN_PITCH
 
 
 def max_pitch():
-    return max(MIDI_pitch.values())
+    return MAX_PITCH
 
 
 def pitch_range():
-    return np.array(range(min_pitch(), max_pitch() + 1))
+    return np.arange(MIN_PITCH, MAX_PITCH + 1)
+
+
+@lru_cache(maxsize=4096)
+def parse_pitch(pitch):
+    """map a pitch spelling (or a string containing an integer) to a midi pitch"""
+    match = pitch_spelling.fullmatch(pitch)
+    if match is None:
+        try:
+            return int(pitch)
+        except ValueError:
+            raise UserWarning("Cannot interpret '{}' as pitch".format(pitch))
+    commas, letter, accidental, apostrophes, number = match.group("commas", "letter", "accidental", "apostrophes",
+                                                                  "number")
+    if (number and (commas or apostrophes)) or (commas and letter.islower()) or (apostrophes and letter.isupper()):
+        raise UserWarning("Cannot interpret '{}' as pitch (mixed octave marks)".format(pitch))
+    octaves = len(commas) + len(apostrophes) + int(number or 0)
+    if letter.isupper():
+        midi_pitch = 36 - 12 * octaves
+    else:
+        midi_pitch = 48 + 12 * octaves
+    midi_pitch += pitch_class[letter.lower()] + accidental_shift[accidental]
+    if not MIN_PITCH <= midi_pitch <= MAX_PITCH:
+        raise UserWarning("Pitch '{}' ({}) is out of range [{}, {}]".format(pitch, midi_pitch, MIN_PITCH, MAX_PITCH))
+    return midi_pitch
 
 
 def to_MIDI_pitch(pitch):
     """map to midi pitch"""
-    if isinstance(pitch, (int, np.int_)):
+    if isinstance(pitch, (int, np.integer)):
         return int(pitch)
     elif isinstance(pitch, str):
-        try:
-            pitch = int(pitch)
-        except ValueError:
-            return MIDI_pitch[pitch]
-        return pitch
+        return parse_pitch(pitch)
     else:
         raise UserWarning("Cannot interpret '{}' (type {}) as pitch".format(pitch, type(pitch)))
 
 
+def to_MIDI_pitch_array(pitches):
+    """map a list or array of pitches (spellings and/or integers) to an array of midi pitches"""
+    pitches = np.asarray(pitches)
+    if pitches.dtype.kind in "iu":
+        return pitches.astype(int)
+    # every distinct spelling is only parsed once
+    spellings, inverse = np.unique(pitches.astype(str), return_inverse=True)
+    midi_pitches = np.array([parse_pitch(spelling) for spelling in spellings], dtype=int)
+    return midi_pitches[inverse].reshape(pitches.shape)
+
+
 @contextmanager
-def transposed(event, transpose_event):
-    event._transpose_list += [(transpose_event._transpose, transpose_event._scale)]
-    event._transpose_list += transpose_event._transpose_list
-    yield
-    event._transpose_list = event._transpose_list[:-1-len(transpose_event._transpose_list)]
+def transposed(transpose_event):
+    """apply the transposition of 'transpose_event' to all events written in the with block (see RenderContext)"""
+    context = Event.context()
+    old_transpose_list = context._transpose_list
+    context._transpose_list = ((transpose_event._transpose, transpose_event._scale),) + old_transpose_list
+    try:
+        yield
+    finally:
+        context._transpose_list = old_transpose_list
 
 
 def metrical_grid(nested_idx):
@@ -125,27 +141,23 @@ def metrical_grid(nested_idx):
     0 0 0 1 1 1 0 0 0 1 1 1  ...
     0 1 2 0 1 2 0 1 2 0 1 2  index)
     """
-    idx = 0
-    for idx, n_idx in reversed(list(enumerate(nested_idx))):
-        if n_idx > 0:
-            break
-    return idx
+    for idx in range(len(nested_idx) - 1, 0, -1):
+        if nested_idx[idx] > 0:
+            return idx
+    return 0
+
+
+def metrical_weight(depth):
+    """default amplitude for a given depth inside the metrical grid"""
+    return 0.05 + 0.95 * np.exp(-depth / 3)
 
 
 def repack_list(list_to_repack, package_sizes=()):
     if not package_sizes:
         return list_to_repack
-    repacked_list = []
-    while list_to_repack:
-        package = []
-        for idx in range(package_sizes[0]):
-            package.append(list_to_repack[0])
-            list_to_repack = list_to_repack[1:]
-            if not list_to_repack:
-                break
-        repacked_list.append(package)
-    package_sizes = package_sizes[1:]
-    return repack_list(repacked_list, package_sizes)
+    for size in package_sizes:
+        list_to_repack = [list(list_to_repack[idx:idx + size]) for idx in range(0, len(list_to_repack), size)]
+    return list_to_repack
 
 
 def rotate(intervals, n):
@@ -158,33 +170,645 @@ def rotate(intervals, n):
 
 
 @contextmanager
-def write_song(file=None, print_to_std_out=False, add_code=""):
-    Event.reset()
-    with io.StringIO() as content:
-        print("# additional code", file=content)
-        print(add_code, file=content)
-        print("", file=content)
-        Event._output_file = content
-        print("# main function", file=content)
-        print("def song", file=content)
-        Event._indent += 1
-        yield
-        Event._indent -= 1
-        print("end", file=content)
-        print("", file=content)
-        Event.write_loops(content)
-        print("", file=content)
-        Event.write_symbols(content)
+def write_song(file=None, print_to_std_out=False, add_code="", stream=False, flush_size=10000, if_changed=None,
+               shards=False, shard_dir=None, context=None):
+    """
+    Write the song to 'file' (replaced atomically at the end). With 'stream=True' the code is written to disk in chunks
+    of 'flush_size' instructions while it is generated instead of being kept in memory. With 'if_changed=True' (the
+    default in watch mode) 'file' is only replaced if its content changes.
+
+    With 'shards=True' the main function, the loop table and each symbol are written to their own files in 'shard_dir'
+    (default: '<file name without extension>_shards' next to 'file') and 'file' becomes an index that loads only the
+    files that changed since they were last loaded. Files are only replaced if their content changes. The shard
+    directory must not contain 'file', and only shards written there before (listed in its
+    '.music_treequence_shards') are removed when they are not needed anymore.
+
+    Instead of a file name, 'file' may also be a SonicPi object to send the code to Sonic Pi directly.
+
+    The song is written in 'context' (default: the current RenderContext), which is reset first and is the current
+    context inside the with block, so several songs can be written at the same time in different threads.
+    """
+    if context is None:
+        context = Event.context()
+    with context.activate():
+        if if_changed is None:
+            if_changed = Event._write_if_changed
+        Event.reset()
+        output = None
+        if (shards or stream) and isinstance(file, SonicPi):
+            raise UserWarning("Songs sent to Sonic Pi cannot be sharded or streamed")
+        if shards and (file is None or stream):
+            raise UserWarning("Sharded songs need an output file and cannot be streamed")
+        if shards:
+            shard_dir = shard_directory(file, shard_dir)
+        if stream:
+            if file is None:
+                raise UserWarning("Cannot stream song without output file")
+            output = temporary_file(file)
+            context._symbol_spool = tempfile.TemporaryFile('w+')
+            content = CodeBuffer(file=output, flush_size=flush_size)
+        else:
+            content = CodeBuffer()
+        try:
+            context._output_file = content
+            content.write("# additional code\n{}\n\n".format(add_code))
+            Event.emit(content, "line", "# main function")
+            Event.emit(content, "line", "def song")
+            context._indent += 1
+            yield
+            context._indent -= 1
+            Event.emit(content, "end")
+            content.write("\n")
+            if shards:
+                write_shards(file, shard_dir, content.getvalue(), print_to_std_out=print_to_std_out)
+                return
+            Event.write_loops(content)
+            content.write("\n")
+            Event.write_symbols(content)
+            if stream:
+                content.write("\n")
+                content.flush()
+                output.close()
+                if print_to_std_out:
+                    with open(output.name) as song:
+                        shutil.copyfileobj(song, sys.stdout)
+                replace_file(output.name, file, if_changed=if_changed)
+            else:
+                content = content.getvalue()
+                if print_to_std_out:
+                    print(content)
+                if isinstance(file, SonicPi):
+                    file.run_code(content, if_changed=if_changed)
+                elif file is not None:
+                    output = temporary_file(file)
+                    with output:
+                        print(content, file=output)
+                    replace_file(output.name, file, if_changed=if_changed)
+        finally:
+            if context._symbol_spool is not None:
+                context._symbol_spool.close()
+                context._symbol_spool = None
+            if output is not None and os.path.exists(output.name):
+                output.close()
+                os.remove(output.name)
+
+
+def shard_directory(file, shard_dir=None):
+    """the absolute directory for the shards of 'file' (see write_song), which must not contain 'file' itself"""
+    if shard_dir is None:
+        shard_dir = os.path.splitext(os.path.abspath(file))[0] + "_shards"
+    shard_dir = os.path.abspath(shard_dir)
+    if os.path.dirname(os.path.abspath(file)) == shard_dir:
+        raise UserWarning("The shard directory '{}' must not contain the song file '{}'".format(shard_dir, file))
+    return shard_dir
+
+
+def write_shards(file, shard_dir, main_code, print_to_std_out=False):
+    """write the main code, the loop table and all symbols to their own files and 'file' as index (see write_song)"""
+    shard_dir = shard_directory(file, shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    # the shards written last time (only these are ever removed)
+    shard_list = os.path.join(shard_dir, ".music_treequence_shards")
+    try:
+        with open(shard_list) as old_shards:
+            old_names = set(old_shards.read().split())
+    except FileNotFoundError:
+        old_names = set()
+    loops = CodeBuffer()
+    Event.write_loops(loops)
+    shards = [("song", main_code), ("loop_test", loops.getvalue())]
+    shards += [(function_name, function) for function_name, function, extent in Event.context()._symbols.values()]
+    index = CodeBuffer()
+    index.write("# index of the song files (files are only loaded again if they changed)\n")
+    Event.emit(index, "line", "$music_treequence_digests ||= {}")
+    Event.emit(index, "line", "[")
+    for name, code in shards:
         if print_to_std_out:
-            print(content.getvalue())
-        if file is not None:
-            with open(file, 'w') as song:
-                print(content.getvalue(), file=song)
+            print(code)
+        shard_file = os.path.join(shard_dir, name + ".rb")
+        output = temporary_file(shard_file)
+        with output:
+            output.write(code)
+        replace_file(output.name, shard_file, if_changed=True)
+        Event.emit(index, "line", "  ['{}', '{}'],".format(shard_file, hashlib.sha1(code.encode()).hexdigest()))
+    Event.emit(index, "line", "].each do |file, digest|")
+    Event.emit(index, "line", "  if $music_treequence_digests[file] != digest")
+    Event.emit(index, "line", "    load file")
+    Event.emit(index, "line", "    $music_treequence_digests[file] = digest")
+    Event.emit(index, "line", "  end")
+    Event.emit(index, "end")
+    # remove files of symbols that do not exist anymore
+    names = [name + ".rb" for name, code in shards]
+    for name in old_names.difference(names):
+        try:
+            os.remove(os.path.join(shard_dir, name))
+        except FileNotFoundError:
+            pass
+    output = temporary_file(shard_list)
+    with output:
+        output.write("".join(name + "\n" for name in names))
+    replace_file(output.name, shard_list, if_changed=True)
+    output = temporary_file(file)
+    with output:
+        output.write(index.getvalue())
+    replace_file(output.name, file, if_changed=True)
+
+
+def temporary_file(file, mode='w'):
+    """a temporary file next to 'file' that can atomically replace it (see replace_file)"""
+    directory, name = os.path.split(os.path.abspath(file))
+    return tempfile.NamedTemporaryFile(mode, dir=directory, prefix="." + name + ".", suffix=".tmp", delete=False)
+
+
+def replace_file(temporary_name, file, if_changed=False):
+    """
+    Atomically replace 'file' by the temporary file (keeping its permissions). With 'if_changed=True' the temporary file
+    is removed instead if both have the same content. Returns whether 'file' was replaced.
+    """
+    if if_changed and os.path.exists(file) and file_digest(file) == file_digest(temporary_name):
+        os.remove(temporary_name)
+        return False
+    try:
+        shutil.copymode(file, temporary_name)
+    except FileNotFoundError:
+        os.chmod(temporary_name, 0o644)
+    os.replace(temporary_name, file)
+    return True
+
+
+def file_digest(file):
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# General MIDI percussion keys for the samples used by Beat
+midi_drums = {
+    ":drum_snare_soft": 38,
+    ":tabla_ghe1": 60,
+    ":drum_bass_soft": 36,
+    ":drum_heavy_kick": 36,
+    ":drum_cymbal_closed": 42,
+    ":drum_cymbal_open": 46,
+    ":drum_cymbal_hard": 51,
+    ":drum_cymbal_soft": 51
+}
+
+
+def write_midi(event, path, ticks_per_beat=480, velocity=100, drums=None):
+    """
+    Write an event as a Standard MIDI File (format 0) with the tempo set by Event.set_beat. Notes (with ties, staccato
+    and transpositions applied as for Sonic Pi) are played on channel 1 with 'velocity' times their amplitude, samples
+    on the percussion channel 10 with the keys given in 'drums' (default: midi_drums); other samples are skipped.
+    Infinite Loops and Symbols cannot be written.
+    """
+    drums = midi_drums if drums is None else drums
+    timeline = Timeline.compile(event)
+    records = timeline.get_records()
+    # keys and channels of notes and samples
+    sample_keys = np.array([drums.get(Timeline.sample_name(sample), -1) for sample in timeline.get_samples()] + [-1],
+                           dtype=int)
+    is_sample = records['sample'] >= 0
+    keys = np.where(is_sample, sample_keys[records['sample']], records['pitch'])
+    channels = np.where(is_sample, 9, 0)
+    amplitudes = np.where(np.isnan(records['amplitude']), 1., records['amplitude'])
+    velocities = np.clip(np.round(amplitudes * velocity), 1, 127).astype(int)
+    # times in ticks (samples are played for a 16th)
+    ticks_per_sec = ticks_per_beat / Event.context()._beat
+    onsets = np.round(records['onset'] * ticks_per_sec).astype(np.int64)
+    offsets = np.where(is_sample,
+                       onsets + ticks_per_beat // 4,
+                       np.round((records['onset'] + records['duration']) * ticks_per_sec).astype(np.int64))
+    offsets = np.maximum(offsets, onsets + 1)
+    keep = (keys >= 0) & (keys < 128)
+    onsets, offsets, keys, channels, velocities = (a[keep] for a in (onsets, offsets, keys, channels, velocities))
+    # note-off (0x80) and note-on (0x90) messages sorted by time with note-offs first
+    ticks = np.concatenate([offsets, onsets])
+    status = np.concatenate([0x80 + channels, 0x90 + channels])
+    data = np.concatenate([keys, keys])
+    data_velocities = np.concatenate([np.zeros_like(velocities), velocities])
+    order = np.lexsort((status >> 4, ticks))
+    ticks, status, data, data_velocities = ticks[order], status[order], data[order], data_velocities[order]
+    deltas = np.diff(ticks, prepend=0)
+    # variable-length quantities: 7 bits per byte, all but the last byte with the high bit set
+    lengths = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    starts = np.concatenate([[0], np.cumsum(lengths + 3)])
+    buffer = np.zeros(starts[-1], dtype=np.uint8)
+    starts = starts[:-1]
+    for byte in range(4):
+        has_byte = lengths > byte
+        shift = 7 * (lengths[has_byte] - 1 - byte)
+        buffer[starts[has_byte] + byte] = ((deltas[has_byte] >> shift) & 0x7f) | \
+            np.where(byte < lengths[has_byte] - 1, 0x80, 0)
+    buffer[starts + lengths] = status
+    buffer[starts + lengths + 1] = data
+    buffer[starts + lengths + 2] = data_velocities
+    tempo = int(round(Event.context()._beat * 1e6)).to_bytes(3, 'big')
+    # the track ends at the extent of the event (or its last note-off, if later)
+    end = max(int(round(timeline.extent() * ticks_per_sec)) - (int(ticks[-1]) if len(ticks) else 0), 0)
+    end_delta = [end & 0x7f]
+    while end >> 7:
+        end >>= 7
+        end_delta.insert(0, end & 0x7f | 0x80)
+    end_of_track = bytes(end_delta) + b"\xff\x2f\x00"
+    track = b"\x00\xff\x51\x03" + tempo + buffer.tobytes() + end_of_track
+    output = temporary_file(path, mode='wb')
+    try:
+        with output:
+            output.write(b"MThd" + struct.pack(">ihhh", 6, 0, 1, ticks_per_beat))
+            output.write(b"MTrk" + struct.pack(">i", len(track)))
+            output.write(track)
+        replace_file(output.name, path)
+    finally:
+        if os.path.exists(output.name):
+            os.remove(output.name)
+
+
+# envelope of notes as written by Sonic Pi code ("play" instruction of CodeBuffer) in sec
+note_attack = 0.01
+note_sustain = 0.1
+note_release = 0.1
+
+
+def sine_oscillator(frequencies, times):
+    return np.sin(np.float32(2 * np.pi) * frequencies * times)
+
+
+def saw_oscillator(frequencies, times):
+    return 2 * ((frequencies * times) % 1) - 1
+
+
+# oscillators approximating Sonic Pi synths (others are rendered with the default sine)
+oscillators = {
+    "beep": sine_oscillator,
+    "sine": sine_oscillator,
+    "saw": saw_oscillator,
+    "dsaw": saw_oscillator,
+}
+
+
+def load_sample(file, sample_rate=44100):
+    """load a PCM WAV file as mono float32 array at the given sample rate (resampled linearly if necessary)"""
+    with wave.open(file, 'rb') as wav:
+        width = wav.getsampwidth()
+        n_channels = wav.getnchannels()
+        rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if width == 1:
+        data = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        data = np.frombuffer(frames, dtype='<i2').astype(np.float32) / 2 ** 15
+    elif width == 4:
+        data = np.frombuffer(frames, dtype='<i4').astype(np.float32) / 2 ** 31
+    else:
+        raise UserWarning("Cannot read {}-bit WAV file '{}'".format(8 * width, file))
+    data = data.reshape(-1, n_channels).mean(axis=1)
+    if rate != sample_rate:
+        times = np.arange(int(len(data) * sample_rate / rate)) * rate / sample_rate
+        data = np.interp(times, np.arange(len(data)), data)
+    return data.astype(np.float32)
+
+
+def render_audio(event, sample_rate=44100, samples=None, gain=0.3, chunk_duration=10., batch_size=2 ** 20):
+    """
+    Render an event (or Timeline) offline and yield the audio in chunks of 'chunk_duration' sec as float32 arrays.
+    Notes use the oscillator of their synth (see oscillators) and the envelope of the Sonic Pi code; samples are taken
+    from 'samples', which maps sample names (like "kick" for Beats or ":drum_bass_soft") to WAV files or arrays (other
+    samples are skipped). Notes are rendered in batches of at most 'batch_size' audio samples.
+    """
+    timeline = event if isinstance(event, Timeline) else Timeline.compile(event)
+    records = timeline.get_records()
+    samples = {} if samples is None else samples
+    beat_names = {name: beat for beat, name in Beat.sounds.items()}
+    sample_data = []
+    for name in map(Timeline.sample_name, timeline.get_samples()):
+        data = samples.get(name, samples.get(name.lstrip(":"), samples.get(beat_names.get(name))))
+        if isinstance(data, str):
+            data = load_sample(data, sample_rate)
+        sample_data.append(np.zeros(0, dtype=np.float32) if data is None else np.asarray(data, dtype=np.float32))
+    # sound sources: the oscillators, then the samples
+    synth_names = [synth.lstrip(":") for synth in timeline.get_synths()]
+    sources = list(oscillators.values())
+    synth_source = np.array([sources.index(oscillators.get(name, sine_oscillator)) for name in synth_names] +
+                            [sources.index(sine_oscillator)], dtype=int)
+    is_sample = records['sample'] >= 0
+    source = np.where(is_sample, len(sources) + records['sample'], synth_source[records['synth']])
+    sample_lengths = np.array([len(data) for data in sample_data] + [0], dtype=np.int64)
+    starts = np.round(records['onset'] * sample_rate).astype(np.int64)
+    lengths = np.where(is_sample,
+                       sample_lengths[records['sample']],
+                       np.ceil((note_attack + records['duration'] + note_sustain + note_release) * sample_rate))
+    ends = starts + lengths.astype(np.int64)
+    frequencies = 440 * 2 ** ((records['pitch'] - 69) / 12)
+    amplitudes = gain * np.where(np.isnan(records['amplitude']), 1., records['amplitude'])
+    durations = records['duration']
+    total = int(np.ceil(timeline.extent() * sample_rate))
+    if len(records):
+        total = max(total, int(ends.max()))
+    max_length = int(lengths.max()) if len(records) else 0
+    chunk = max(1, int(chunk_duration * sample_rate))
+    for chunk_start in range(0, total, chunk):
+        chunk_end = min(chunk_start + chunk, total)
+        buffer = np.zeros(chunk_end - chunk_start, dtype=np.float32)
+        # records are sorted by onset and no record is longer than max_length
+        first = np.searchsorted(starts, chunk_start - max_length, side='right')
+        last = np.searchsorted(starts, chunk_end, side='left')
+        active = first + np.flatnonzero(ends[first:last] > chunk_start)
+        for src in np.unique(source[active]).tolist():
+            notes = active[source[active] == src]
+            begins = np.maximum(starts[notes], chunk_start)
+            counts = np.minimum(ends[notes], chunk_end) - begins
+            # split into batches of about batch_size audio samples (a batch may exceed it by one note)
+            total_counts = np.cumsum(counts)
+            splits = np.unique(np.searchsorted(total_counts, np.arange(batch_size, total_counts[-1], batch_size),
+                                               side='right'))
+            for batch in np.split(np.arange(len(notes)), splits):
+                if len(batch) == 0:
+                    continue
+                batch_counts = counts[batch]
+                batch_notes = notes[batch]
+                # position of each audio sample in the buffer and time since the onset of its note
+                offsets = np.arange(batch_counts.sum()) - np.repeat(np.cumsum(batch_counts) - batch_counts,
+                                                                    batch_counts)
+                positions = np.repeat(begins[batch] - chunk_start, batch_counts) + offsets
+                elapsed = np.repeat(begins[batch] - starts[batch_notes], batch_counts) + offsets
+                if src < len(sources):
+                    times = elapsed.astype(np.float32) / np.float32(sample_rate)
+                    release_start = np.repeat((note_attack + durations[batch_notes] + note_sustain).astype(np.float32),
+                                              batch_counts)
+                    envelope = np.minimum(times / np.float32(note_attack),
+                                          (release_start - times) / np.float32(note_release) + 1)
+                    values = sources[src](np.repeat(frequencies[batch_notes].astype(np.float32), batch_counts), times)
+                    values *= np.clip(envelope, 0, 1, out=envelope)
+                else:
+                    values = sample_data[src - len(sources)][elapsed]
+                values *= np.repeat(amplitudes[batch_notes].astype(np.float32), batch_counts)
+                buffer += np.bincount(positions, weights=values, minlength=len(buffer)).astype(np.float32)
+        yield buffer
+
+
+def write_wav(event, path, sample_rate=44100, samples=None, gain=0.3, chunk_duration=10., batch_size=2 ** 20):
+    """render an event offline (see render_audio) and write it as 16-bit mono WAV file"""
+    output = temporary_file(path, mode='wb')
+    try:
+        with output, wave.open(output, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            for buffer in render_audio(event, sample_rate=sample_rate, samples=samples, gain=gain,
+                                       chunk_duration=chunk_duration, batch_size=batch_size):
+                wav.writeframes((np.clip(buffer, -1, 1) * (2 ** 15 - 1)).astype('<i2').tobytes())
+        replace_file(output.name, path)
+    finally:
+        if os.path.exists(output.name):
+            os.remove(output.name)
+
+
+class CodeBuffer:
+    """
+    Collects Sonic Pi code as instruction tuples (indent, operation, arguments) and formats all of them at once. Plain
+    text can be added via write(), so a CodeBuffer can also be used as a file, e.g. with print().
+    """
+
+    formats = {
+        "line": "{}",
+        "play": "play {}, attack: 0.01, decay: {}, sustain: 0.1, release: 0.1, amp: {}",
+        "play_chord": "play_chord [{}], attack: 0.01, decay: {}, sustain: 0.1, release: 0.1, amp: {}",
+        "sample": "sample {}",
+        "sample_amp": "sample {}, amp: {}",
+        "sleep": "sleep {}",
+        "use_synth": "use_synth {}",
+        "call": "{} # {}",
+        "def": "def {} # {}",
+        "times": "{}.times do",
+        "in_thread": "in_thread do",
+        "while": "while loop_test('{}')",
+        "end": "end",
+    }
+    _line_formats = {}
+    # operations that can be repeated in "times" blocks
+    repeatable = {"play", "play_chord", "sample", "sample_amp", "sleep", "use_synth", "call"}
+    # operations that change neither the synth nor the control flow
+    straight = {"play", "play_chord", "sample", "sample_amp", "sleep", "use_synth"}
+    # optimization passes in the order they are applied (see Event.set_optimizations)
+    passes = ("drop_zero_sleeps", "merge_sleeps", "drop_repeated_synths", "play_chords", "compress_repetitions")
+
+    @staticmethod
+    def drop_zero_sleeps(instructions):
+        return [instruction for instruction in instructions
+                if not (instruction[1] == "sleep" and isinstance(instruction[2][0], (int, float))
+                        and instruction[2][0] == 0)]
+
+    @staticmethod
+    def merge_sleeps(instructions):
+        """replace directly consecutive sleeps (at the same indent) by a single one"""
+        merged = []
+        for instruction in instructions:
+            if instruction[1] == "sleep" and merged and merged[-1][1] == "sleep" and merged[-1][0] == instruction[0] \
+                    and isinstance(instruction[2][0], (int, float)) and isinstance(merged[-1][2][0], (int, float)):
+                merged[-1] = (instruction[0], "sleep", (round(merged[-1][2][0] + instruction[2][0], 10),))
+            else:
+                merged.append(instruction)
+        return merged
+
+    @staticmethod
+    def drop_repeated_synths(instructions):
+        """drop "use_synth" instructions that select the synth already in use"""
+        kept = []
+        synth = None
+        indent = None
+        for instruction in instructions:
+            if instruction[1] not in CodeBuffer.straight or instruction[0] != indent:
+                # the synth may have been changed (e.g. by a called function)
+                synth = None
+                indent = instruction[0]
+            if instruction[1] == "use_synth":
+                if instruction[2] == synth:
+                    continue
+                synth = instruction[2]
+            kept.append(instruction)
+        return kept
+
+    @staticmethod
+    def play_chords(instructions):
+        """
+        Merge notes that are played at the same time (i.e. without sleep, synth change or other instructions than
+        samples in between) with the same duration and amplitude into one "play_chord".
+        """
+        grouped = []
+        chords = []
+        current = {}
+        for instruction in instructions:
+            indent, operation, arguments = instruction
+            if operation == "play":
+                key = (indent,) + arguments[1:]
+                if key in current:
+                    current[key][1].append(arguments[0])
+                    continue
+                current[key] = (len(grouped), [arguments[0]])
+                chords.append(current[key])
+            elif operation not in ("sample", "sample_amp"):
+                current = {}
+            grouped.append(instruction)
+        for position, pitches in chords:
+            if len(pitches) > 1:
+                indent, _, arguments = grouped[position]
+                grouped[position] = (indent, "play_chord", (", ".join(map(str, pitches)),) + arguments[1:])
+        return grouped
+
+    @staticmethod
+    def compress_repetitions(instructions, max_period=64):
+        """
+        Replace runs of repeated instructions (at the same indent) by "times" blocks where this saves lines. Runs are
+        found greedily: at each position the period of at most 'max_period' instructions saving most lines is used.
+        """
+        n = len(instructions)
+        if n < 4:
+            return list(instructions)
+        ids = {}
+        # instructions that cannot be repeated get unique negative keys, so they never match
+        keys = np.array([ids.setdefault(instruction, len(ids))
+                         if instruction[1] in CodeBuffer.repeatable else -1 - idx
+                         for idx, instruction in enumerate(instructions)], dtype=np.int64)
+        # best saving (in lines) and period of a repetition starting at each position
+        best_saving = np.zeros(n, dtype=np.int64)
+        best_period = np.zeros(n, dtype=np.int64)
+        positions = np.arange(n)
+        for period in range(1, min(max_period, n // 2) + 1):
+            # a pattern repeats count times iff the instructions match their successors 'period' positions ahead for
+            # (count - 1) * period positions
+            mismatch = np.where(keys[:-period] != keys[period:], positions[:-period], n - period)
+            matching = np.minimum.accumulate(mismatch[::-1])[::-1] - positions[:-period]
+            # the repeated lines are replaced by one pattern plus "times" and "end"
+            saving = (matching // period) * period - 2
+            better = saving > best_saving[:-period]
+            best_saving[:-period][better] = saving[better]
+            best_period[:-period][better] = period
+        compressed = []
+        idx = 0
+        while idx < n:
+            period = int(best_period[idx])
+            indent = instructions[idx][0]
+            if period > 0 and all(instruction[0] == indent for instruction in instructions[idx:idx + period]):
+                count = 1 + (int(best_saving[idx]) + 2) // period
+                body = [(indent + 1, operation, arguments)
+                        for _, operation, arguments in instructions[idx:idx + period]]
+                compressed.append((indent, "times", (count,)))
+                compressed += CodeBuffer.compress_repetitions(body, max_period=max_period)
+                compressed.append((indent, "end", ()))
+                idx += period * count
+            else:
+                compressed.append(instructions[idx])
+                idx += 1
+        return compressed
+
+    @staticmethod
+    def optimize(instructions):
+        """apply the enabled optimization passes and count the lines they save (see Event.optimization_info)"""
+        savings = Event.context()._optimization_savings
+        savings["before"] += len(instructions)
+        for name in CodeBuffer.passes:
+            if not Event._optimizations[name]:
+                continue
+            count = len(instructions)
+            if name == "compress_repetitions":
+                instructions = CodeBuffer.compress_repetitions(instructions, max_period=Event._repetition_max_period)
+            else:
+                instructions = getattr(CodeBuffer, name)(instructions)
+            savings[name] += count - len(instructions)
+        savings["after"] += len(instructions)
+        return instructions
+
+    @staticmethod
+    def format(instructions):
+        line_formats = CodeBuffer._line_formats
+        lines = []
+        for indent, operation, arguments in instructions:
+            if operation is None:
+                lines.append(arguments)
+                continue
+            try:
+                line_format = line_formats[indent, operation]
+            except KeyError:
+                line_format = ("  " * indent + CodeBuffer.formats[operation] + "\n").format
+                line_formats[indent, operation] = line_format
+            lines.append(line_format(*arguments))
+        return "".join(lines)
+
+    def __init__(self, file=None, flush_size=10000):
+        """If 'file' is given, instructions are formatted and written to it whenever 'flush_size' are pending"""
+        self._instructions = []
+        self._file = file
+        self._flush_size = flush_size
+
+    def add(self, indent, operation, *arguments):
+        self._instructions.append((indent, operation, arguments))
+        self.check_flush()
+
+    def extend(self, instructions):
+        self._instructions.extend(instructions)
+        self.check_flush()
+
+    def write(self, text):
+        self._instructions.append((None, None, text))
+        self.check_flush()
+
+    def check_flush(self):
+        if self._file is not None and len(self._instructions) >= self._flush_size:
+            self.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.write(CodeBuffer.format(CodeBuffer.optimize(self._instructions)))
+            self._instructions = []
+
+    def getvalue(self):
+        return CodeBuffer.format(CodeBuffer.optimize(self._instructions))
 
 
 class TonicScale:
+    """
+    A scale given by its tonic and the set of pitch classes (intervals above the tonic) it contains. The pitch-class
+    set is stored as a 12-bit mask (bit i is set if interval i is in the scale) and all queries are answered from lookup
+    tables that are shared by all scales (see pitch_class_tables).
+    """
 
-    def __init__(self, tonic=None, intervals=range(12), pitches=None):
+    _pitch_class_tables = None
+
+    @staticmethod
+    def pitch_class_tables():
+        """
+        Lookup tables for all 4096 pitch-class sets (built on first use). All tables are indexed by [mask, interval]
+        with 0 <= interval < 12:
+            - 'member': whether interval is in the set
+            - 'next': number of semitones from interval up to the next interval in the set (0 for members)
+            - 'degree': scale degree of that next interval
+            - 'interval': the interval of each scale degree (only the first 'size' entries are valid)
+        and 'size' is indexed by mask only.
+        """
+        if TonicScale._pitch_class_tables is None:
+            intervals = np.arange(12)
+            member = (np.arange(4096)[:, None] >> intervals) & 1 == 1
+            next_interval = np.zeros(member.shape, dtype=np.int8)
+            for distance in reversed(range(1, 12)):
+                # the smallest distance to a member is assigned last
+                next_interval[:, intervals] = np.where(member[:, (intervals + distance) % 12],
+                                                       distance, next_interval[:, intervals])
+            next_interval[member] = 0
+            rank = np.cumsum(member, axis=1) - 1
+            degree = np.take_along_axis(rank, (intervals + next_interval) % 12, axis=1).astype(np.int8)
+            TonicScale._pitch_class_tables = {
+                'member': member,
+                'next': next_interval,
+                'degree': degree,
+                'interval': np.argsort(~member, axis=1, kind='stable').astype(np.int8),
+                'size': member.sum(axis=1)
+            }
+        return TonicScale._pitch_class_tables
+
+    def __init__(self, tonic=None, intervals=range(12), pitches=None, mask=None):
         if isinstance(intervals, str):
             if intervals == 'major':
                 intervals = [0, 2, 4, 5, 7, 9, 11]
@@ -192,6 +816,10 @@ class TonicScale:
                 intervals = [0, 2, 3, 5, 7, 8, 10]
             else:
                 raise UserWarning("Unknown scale '{}' given as intervals parameter".format(intervals))
+        if mask is not None:
+            if not 0 < mask < 4096:
+                raise UserWarning("Scale mask must be in [1, 4095], not {}".format(mask))
+            intervals = [i for i in range(12) if mask >> i & 1]
         if pitches is not None:
             if tonic is None:
                 self._tonic = pitches[0]
@@ -205,41 +833,232 @@ class TonicScale:
             raise UserWarning("Scale cannot contain negative intervals.")
         if self._intervals[-1] > 11:
             raise UserWarning("Scale cannot contain intervals of an octave or above.")
+        self._mask = sum(1 << int(i) for i in self._intervals)
+        self._interval_tuple = tuple(int(i) for i in self._intervals)
+        self._tonic_pitch = to_MIDI_pitch(self._tonic)
+        # transposition tables by number of scale degrees
+        self._tables = {}
+
+    @property
+    def tonic(self):
+        """the tonic (pitch name or MIDI pitch); setting it updates the cached pitch and transposition tables"""
+        return self._tonic
+
+    @tonic.setter
+    def tonic(self, tonic):
+        self._tonic = tonic
+        self._tonic_pitch = to_MIDI_pitch(tonic)
+        # composed tables of chains with this scale are recomputed as well (see Timeline.transposition_table)
+        self._tables = {}
 
     def __repr__(self):
-        return str([to_MIDI_pitch(self._tonic) + i for i in self._intervals])
+        return str([self._tonic_pitch + i for i in self._interval_tuple])
+
+    def get_mask(self):
+        return self._mask
 
     def get_interval(self, scale_degree):
-        return self._intervals[scale_degree % len(self._intervals)] + 12 * (scale_degree // len(self._intervals))
+        n = len(self._interval_tuple)
+        return self._interval_tuple[scale_degree % n] + 12 * (scale_degree // n)
 
     def get_scale_degree(self, pitch):
-        return np.argmin((self._intervals + to_MIDI_pitch(self._tonic) - to_MIDI_pitch(pitch)) % 12)
+        """the scale degree of pitch or, if it is not in the scale, of the next pitch above that is"""
+        tables = TonicScale.pitch_class_tables()
+        return int(tables['degree'][self._mask, (to_MIDI_pitch(pitch) - self._tonic_pitch) % 12])
 
     def is_in_scale(self, pitch):
-        degree = self.get_scale_degree(pitch)
-        return (to_MIDI_pitch(self._tonic) + self.get_interval(degree) - to_MIDI_pitch(pitch)) % 12 == 0
+        tables = TonicScale.pitch_class_tables()
+        return bool(tables['member'][self._mask, (to_MIDI_pitch(pitch) - self._tonic_pitch) % 12])
+
+    def next_in_scale(self, pitch):
+        """the lowest pitch in the scale that is not below pitch"""
+        pitch = to_MIDI_pitch(pitch)
+        tables = TonicScale.pitch_class_tables()
+        return pitch + int(tables['next'][self._mask, (pitch - self._tonic_pitch) % 12])
+
+    def get_interval_array(self, scale_degrees):
+        """get_interval for an array of scale degrees"""
+        scale_degrees = np.asarray(scale_degrees)
+        n = len(self._interval_tuple)
+        return self._intervals[scale_degrees % n] + 12 * (scale_degrees // n)
+
+    def get_scale_degree_array(self, pitches):
+        """get_scale_degree for an array of MIDI pitches"""
+        tables = TonicScale.pitch_class_tables()
+        return tables['degree'][self._mask, (np.asarray(pitches) - self._tonic_pitch) % 12].astype(int)
+
+    def is_in_scale_array(self, pitches):
+        """is_in_scale for an array of MIDI pitches"""
+        tables = TonicScale.pitch_class_tables()
+        return tables['member'][self._mask, (np.asarray(pitches) - self._tonic_pitch) % 12]
+
+    def next_in_scale_array(self, pitches):
+        """next_in_scale for an array of MIDI pitches"""
+        pitches = np.asarray(pitches)
+        tables = TonicScale.pitch_class_tables()
+        return pitches + tables['next'][self._mask, (pitches - self._tonic_pitch) % 12]
+
+    def transpose_pitches(self, pitches, transpose):
+        """
+        Transpose an array of MIDI pitches by the given number of scale degrees (pitches that are not in the scale keep
+        their distance to the scale degree returned by get_scale_degree).
+        """
+        pitches = np.asarray(pitches)
+        degrees = self.get_scale_degree_array(pitches)
+        return pitches - self.get_interval_array(degrees) + self.get_interval_array(degrees + transpose)
+
+    def transposition_table(self, transpose):
+        """lookup table mapping each of the 128 MIDI pitches to the pitch transposed by the given scale degrees"""
+        try:
+            return self._tables[transpose]
+        except KeyError:
+            table = self._tables[transpose] = self.transpose_pitches(np.arange(128), transpose)
+            return table
+
+
+# default scale shared by all events
+chromatic_scale = TonicScale()
+
+
+class RenderContext:
+    """
+    The state of writing a song: the indent of the written code, the transpositions of the enclosing events (pairs of
+    transpose and scale, innermost first), the duration of a beat, the tables of symbols and loops, the output file,
+    composed transposition tables and statistics of the written code and the extent cache. Events are written in the
+    current context of the thread (or asyncio task), which is default_context unless another context is activated, e.g.
+    by write_song(context=...) or write(context=...). Songs can thus be written concurrently, each in its own context.
+    """
+
+    # extent cache generations are unique across all contexts, so events shared by several contexts are never stale
+    _generations = itertools.count(1)
+
+    def __init__(self, beat=1):
+        self._indent = 0
+        self._transpose_list = ()
+        self._beat = beat
+        self._symbols = {}
+        # insertion ordered, so the written code does not depend on string hashing
+        self._loops = {}
+        self._output_file = None
+        self._symbol_spool = None
+        # interned contents of events and the symbols of the parts written as shared functions by their contents, None
+        # for parts too small to be shared (see Sequence.content_id)
+        self._contents = {}
+        self._shared_parts = {}
+        self._optimization_savings = dict.fromkeys(("before", "after") + CodeBuffer.passes, 0)
+        # composed transposition tables by chain of (transpose, scale) pairs with the tonics they were computed for
+        # (see Timeline.transposition_table)
+        self._transposition_tables = {}
+        self._extent_cache_hits = 0
+        self._extent_cache_misses = 0
+        self._extent_generation = next(RenderContext._generations)
+
+    def reset(self):
+        self._indent = 0
+        self._transpose_list = ()
+        self._beat = 1
+        self._symbols = {}
+        self._loops = {}
+        self._contents = {}
+        self._shared_parts = {}
+        self._optimization_savings = dict.fromkeys(self._optimization_savings, 0)
+        self._transposition_tables = {}
+        self._extent_cache_hits = 0
+        self._extent_cache_misses = 0
+        self.invalidate_extents()
+
+    def invalidate_extents(self):
+        self._extent_generation = next(RenderContext._generations)
+
+    @contextmanager
+    def activate(self):
+        """make this the current context while the with block runs"""
+        token = _current_context.set(self)
+        try:
+            yield self
+        finally:
+            _current_context.reset(token)
+
+
+# context used unless another one is activated
+default_context = RenderContext()
+_current_context = contextvars.ContextVar("render_context", default=default_context)
+
+
+def rendering(method):
+    """let 'method' take an optional 'context' (keyword) argument that is the current RenderContext while it runs"""
+    @wraps(method)
+    def method_in_context(*args, context=None, **kwargs):
+        if context is None or context is _current_context.get():
+            return method(*args, **kwargs)
+        with context.activate():
+            return method(*args, **kwargs)
+    return method_in_context
 
 
 class Event:
 
-    _indent = 0
-    _beat = 1
-    _symbols = {}
-    _loops = set()
+    # atomic events are numerous, so all of them use __slots__ (other events have a __dict__ in addition)
+    __slots__ = ('_transpose', '_scale', '_extent_cache', '__weakref__')
+
     _str_verbose = True
-    _output_file = None
+    _hash_consing = True
+    _hash_consing_min_records = 8
+    _optimizations = dict.fromkeys(CodeBuffer.passes, True)
+    _repetition_max_period = 64
+    _flyweights = weakref.WeakValueDictionary()
+    _write_if_changed = False
+    _parallel_threads = False
+    # switches set by songs (restored after each variant of render_batch)
+    _settings = ("_str_verbose", "_hash_consing", "_hash_consing_min_records", "_optimizations",
+                 "_repetition_max_period", "_write_if_changed", "_parallel_threads")
+
+    @staticmethod
+    def context():
+        """the current RenderContext"""
+        return _current_context.get()
 
     @staticmethod
     def reset():
-        Event._indent = 0
-        Event._beat = 1
-        Event._symbols = {}
-        Event._loops = set()
+        Event.context().reset()
+
+    @staticmethod
+    def invalidate_extents():
+        """invalidate the cached extents of all events (in the current context)"""
+        Event.context().invalidate_extents()
+
+    @staticmethod
+    @rendering
+    def extent_cache_info():
+        """hits and misses of the extent cache since the last reset and its generation (in the current context)"""
+        context = Event.context()
+        return {"hits": context._extent_cache_hits,
+                "misses": context._extent_cache_misses,
+                "generation": context._extent_generation}
+
+    @staticmethod
+    @rendering
+    def optimization_info():
+        """
+        Number of instructions (i.e. lines, apart from plain text) written since the last reset ("before" and "after"
+        optimization) and the lines saved by each optimization pass.
+        """
+        return dict(Event.context()._optimization_savings)
 
     @staticmethod
     def write_indent(file):
-        for _ in range(Event._indent):
-            print("  ", end="", file=file)
+        print("  " * Event.context()._indent, end="", file=file)
+
+    @staticmethod
+    def emit(file, operation, *arguments):
+        Event.emit_all(file, [(Event.context()._indent, operation, arguments)])
+
+    @staticmethod
+    def emit_all(file, instructions):
+        if isinstance(file, CodeBuffer):
+            file.extend(instructions)
+        else:
+            file.write(CodeBuffer.format(CodeBuffer.optimize(instructions)))
 
     @staticmethod
     def time_interval(extent):
@@ -252,11 +1071,11 @@ class Event:
                 return float(extent[:-2])/1000
             elif extent.endswith("b"):
                 # beats --> sec
-                return float(extent[:-1]) * Event._beat
+                return float(extent[:-1]) * Event.context()._beat
             elif '/' in extent:
                 # x/y --> sec [1/4 = 1 beat]
                 parts = extent.split('/')
-                return 4 * float(parts[0]) / float(parts[1]) * Event._beat
+                return 4 * float(parts[0]) / float(parts[1]) * Event.context()._beat
             else:
                 # --> sec
                 return float(extent)
@@ -266,13 +1085,61 @@ class Event:
 
     @staticmethod
     def set_beat(beat):
+        context = Event.context()
         if isinstance(beat, str):
             if beat.endswith('bpm'):
-                Event._beat = float(60 / float(beat[:-3]))
+                context._beat = float(60 / float(beat[:-3]))
             else:
-                Event._beat = float(beat)
+                context._beat = float(beat)
         else:
-            Event._beat = beat
+            context._beat = beat
+        # extents given in beats have changed
+        Event.invalidate_extents()
+
+    @staticmethod
+    def set_hash_consing(enabled=True, min_records=8):
+        """
+        Identical parts of sequences (child sequences/measures, parallel blocks, transposed events) with at least
+        'min_records' notes/samples are written only once as a function and called wherever they occur.
+        """
+        Event._hash_consing = enabled
+        Event._hash_consing_min_records = min_records
+
+    @staticmethod
+    def set_repetition_compression(enabled=True, max_period=64):
+        """
+        Directly repeated runs of up to 'max_period' instructions in the written code are replaced by "n.times do"
+        blocks.
+        """
+        Event._optimizations["compress_repetitions"] = enabled
+        Event._repetition_max_period = max_period
+
+    @staticmethod
+    def set_parallel_threads(enabled=True):
+        """
+        Write each voice of a Parallel as its own "in_thread" block instead of interleaving all voices into one stream
+        of notes and sleeps (can be overridden per Parallel with its 'threads' parameter).
+        """
+        Event._parallel_threads = enabled
+
+    @staticmethod
+    def set_optimizations(enabled=None, **passes):
+        """
+        Switch optimization passes of the written code on or off: all of them with 'enabled' and single ones by name,
+        e.g. set_optimizations(play_chords=False). The passes are
+         - drop_zero_sleeps: remove "sleep 0"
+         - merge_sleeps: merge consecutive sleeps
+         - drop_repeated_synths: remove "use_synth" if the synth is already in use
+         - play_chords: play notes starting at the same time with the same parameters with "play_chord"
+         - compress_repetitions: see set_repetition_compression
+        """
+        for name in passes:
+            if name not in Event._optimizations:
+                raise UserWarning("Unknown optimization pass '{}' (known are {})".format(name, CodeBuffer.passes))
+        if enabled is not None:
+            for name in Event._optimizations:
+                Event._optimizations[name] = enabled
+        Event._optimizations.update(passes)
 
     @staticmethod
     def random_string(length=10, lower=True, upper=False, digits=False):
@@ -287,96 +1154,188 @@ class Event:
 
     @staticmethod
     def write_symbols(file):
-        print("# symbols", file=file)
-        print("", file=file)
-        for function_name, function, extent in Event._symbols.values():
-            print(function, file=file)
-            print("", file=file)
+        context = Event.context()
+        file.write("# symbols\n\n")
+        for function_name, function, extent in context._symbols.values():
+            if function is not None:
+                file.write(function)
+                file.write("\n")
+        if context._symbol_spool is not None:
+            # symbols written to disk while streaming
+            context._symbol_spool.seek(0)
+            for chunk in iter(lambda: context._symbol_spool.read(2 ** 16), ""):
+                file.write(chunk)
+                file.flush()
 
     @staticmethod
     def write_loops(file):
-        print("# function for testing infinite loops", file=file)
-        print("def loop_test(key)", file=file)
-        print("  loops = [", file=file)
-        for name in Event._loops:
-            print("    '{}',".format(name), file=file)
-        print("  ].to_set", file=file)
-        print("  return loops.include?(key)", file=file)
-        print("end", file=file)
+        Event.emit_all(file, [(0, "line", ("# function for testing infinite loops",)),
+                              (0, "line", ("def loop_test(key)",)),
+                              (1, "line", ("loops = [",))] +
+                       [(2, "line", ("'{}',".format(name),)) for name in Event.context()._loops] +
+                       [(1, "line", ("].to_set",)),
+                        (1, "line", ("return loops.include?(key)",)),
+                        (0, "end", ())])
 
     @staticmethod
     def add_loop(name):
-        if name in Event._loops:
+        loops = Event.context()._loops
+        if name in loops:
             raise UserWarning("Loop '{}' already exists".format(name))
         else:
-            Event._loops.add(name)
+            loops[name] = None
+
+    # a single event of the text notation: "r" (rest), "b:<sound>" (beat) or a pitch followed by "_" (tie) and/or "."
+    # (staccato) modifiers, each optionally followed by "/<n>" for a length of 1/n (anything after a second "/" is
+    # ignored)
+    _token = re.compile(r"""\s*(?P<token>
+                            (?:(?P<rest>[rR])
+                               |(?P<beat>[bB]:[^\s/]*)
+                               |(?P<pitch>[^\s/_.]*(?:[_.]+[^\s/_.]+)*)(?P<modifiers>[_.]*))
+                            (?:/(?P<length>[^\s/]*)(?:/\S*)?)?
+                            )(?=\s|$)""", re.VERBOSE)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def parse_token(token):
+        """parse a single event of the text notation (the event may be shared, like all events)"""
+        match = Event._token.fullmatch(token)
+        if match is None:
+            raise UserWarning("Cannot parse '{}' as event".format(token))
+        return Event._parse_match(match)
+
+    @staticmethod
+    def _parse_match(match):
+        length = "1b" if match.group("length") is None else "1/" + match.group("length")
+        if match.group("rest") is not None:
+            return Rest(length)
+        if match.group("beat") is not None:
+            return Beat(length, sound=match.group("beat")[2:])
+        modifiers = match.group("modifiers")
+        return Tone(pitch=match.group("pitch"), duration=length, tie="_" in modifiers, staccato="." in modifiers)
+
+    @staticmethod
+    def tokenize(source):
+        """
+        Yield the events of a text score in one pass. source may be a string or a file object, which is read line by
+        line.
+        """
+        lines = [source] if isinstance(source, str) else source
+        for line in lines:
+            pos = 0
+            end = len(line.rstrip())
+            while pos < end:
+                match = Event._token.match(line, pos)
+                token = match.group("token")
+                # repeated tokens are parsed only once
+                yield Event.parse_token(token)
+                pos = match.end()
 
     @staticmethod
     def parse(event, agglomeration_type="Sequence"):
-        if isinstance(event, str):
-            # string should be single event or sequence of events separated by whitespace
-            list = event.split()
-            if len(list) > 1:
-                # sequence
-                sequence = []
-                for e in list:
-                    sequence.append(Event.parse(e))
-                if agglomeration_type == "Sequence":
-                    return Sequence(sequence)
-                elif agglomeration_type == "Parallel":
-                    return Parallel(sequence)
-                else:
-                    raise UserWarning("Unknown agglomeration type {}".format(agglomeration_type))
-            else:
-                # single event
-                vals = event.split('/')
-                length = "1b"
-                if len(vals) > 1:
-                    length = "1/" + vals[1]
-                if vals[0] == 'r' or vals[0] == 'R':
-                    return Rest(length)
-                if vals[0][0:2].lower() == 'b:':
-                    return Beat(length, sound=vals[0][2:])
-                else:
-                    pitch = vals[0]
-                    tie = False
-                    staccato = False
-                    while pitch.endswith("_") or pitch.endswith("."):
-                        if pitch.endswith("_"):
-                            pitch = pitch[:-1]
-                            tie = True
-                        if pitch.endswith("."):
-                            pitch = pitch[:-1]
-                            staccato = True
-                    return Tone(pitch=pitch, duration=length, tie=tie, staccato=staccato)
-        else:
+        """
+        Parse a text score (a string or a file object) into a single event if it contains only one or into a Sequence
+        or Parallel of events otherwise. Events are passed through.
+        """
+        if not isinstance(event, (str, io.IOBase)):
             # just pass through
             return event
+        sequence = list(Event.tokenize(event))
+        if len(sequence) == 1:
+            return sequence[0]
+        if agglomeration_type == "Sequence":
+            return Sequence(sequence)
+        elif agglomeration_type == "Parallel":
+            return Parallel(sequence)
+        else:
+            raise UserWarning("Unknown agglomeration type {}".format(agglomeration_type))
+
+    @staticmethod
+    def parse_lines(file, agglomeration_type="Sequence"):
+        """parse each non-empty line of a text file (e.g. a corpus of melodies) into an event"""
+        for line in file:
+            if line.strip():
+                yield Event.parse(line, agglomeration_type=agglomeration_type)
 
     @staticmethod
     def wait(time, file):
-        Event.write_indent(file=file)
-        print("sleep {}".format(time), file=file)
+        Event.emit(file, "sleep", time)
 
-    def __init__(self, transpose=0, scale=TonicScale()):
+    def __init__(self, transpose=0, scale=chromatic_scale):
         self._transpose = transpose
         self._scale = scale
-        self._transpose_list = []
+        self._extent_cache = None
 
+    @staticmethod
+    def add_symbol(symbol, function_name, write, extent):
+        """add a function to the symbol table whose body is written by calling write(file)"""
+        context = Event.context()
+        if symbol in context._symbols:
+            # extents of Symbols and Loops may change
+            context.invalidate_extents()
+        spool = context._symbol_spool
+        if spool is None:
+            file = CodeBuffer()
+        else:
+            # symbols may be created while writing another one, so each gets its own temporary file
+            file = CodeBuffer(file=tempfile.TemporaryFile('w+'))
+        # the body is written at the top level of the function, whatever is being written at the moment
+        old_indent, old_transpose_list = context._indent, context._transpose_list
+        file.add(0, "def", function_name, symbol)
+        context._indent, context._transpose_list = 1, ()
+        try:
+            write(file)
+        finally:
+            context._indent, context._transpose_list = old_indent, old_transpose_list
+        file.add(0, "end")
+        if spool is None:
+            context._symbols[symbol] = (function_name, file.getvalue(), extent)
+        else:
+            file.write("\n")
+            file.flush()
+            with file._file as function:
+                function.seek(0)
+                shutil.copyfileobj(function, spool)
+            context._symbols[symbol] = (function_name, None, extent)
+
+    @rendering
     def create_symbol(self, symbol, random_name=False):
         function_name = Event.random_string() if random_name else "function_"+symbol
-        with io.StringIO() as file:
-            old_indent = Event._indent
-            print("def {} # {}".format(function_name, symbol), file=file)
-            Event._indent = 1
-            self.write(file)
-            print("end", end='', file=file)
-            Event._indent = old_indent
-            Event._symbols[symbol] = (function_name, file.getvalue(), self.extent())
+        Event.add_symbol(symbol, function_name, self.write, self.extent())
+
+    def replace(self, **attributes):
+        """
+        Return a copy of the event with the given attributes replaced (e.g. replace(extent='1/8')). Events may be shared
+        between several places in a tree, so they should not be modified in place but replaced by a modified copy.
+        """
+        event = copy(self)
+        for name, value in attributes.items():
+            setattr(event, "_" + name, value)
+        event._extent_cache = None
+        return event
+
+    def flyweight(self):
+        """
+        Return a shared instance equal to this event (atomic events only). Identical atomic events (like the beats of a
+        drum pattern) can thus be represented by a single object.
+        """
+        key = [type(self)]
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if name not in ('_extent_cache', '__weakref__'):
+                    value = getattr(self, name)
+                    key.append(tuple(value) if isinstance(value, list) else value)
+        key = tuple(key)
+        try:
+            return Event._flyweights[key]
+        except KeyError:
+            Event._flyweights[key] = self
+            return self
 
     def transpose(self, trp):
+        """a copy transposed by 'trp' (the event itself is not changed, see replace)"""
         if self.is_transposable():
-            self._transpose = trp
+            return self.replace(transpose=trp)
         return self
 
     def is_atomic(self):
@@ -386,14 +1345,34 @@ class Event:
         return False
 
     def extent(self):
+        """the extent in sec (cached until Event.invalidate_extents is called or the event is changed)"""
+        cache = self._extent_cache
+        context = _current_context.get()
+        generation = context._extent_generation
+        if cache is not None and cache[0] == generation:
+            context._extent_cache_hits += 1
+            return cache[1]
+        context._extent_cache_misses += 1
+        extent = self.compute_extent()
+        self._extent_cache = (generation, extent)
+        return extent
+
+    def compute_extent(self):
         return 0
 
+    def has_threads(self):
+        """whether the event contains Parallels that are written with threads (see Event.set_parallel_threads)"""
+        return False
+
+    @rendering
     def write(self, file=None):
-        pass
+        Timeline.compile(self).write(file)
 
 
 class Chord(Event):
 
+    __slots__ = ('_intervals', '_base', '_duration', '_extent', '_amplitude', '_tie', '_staccato', '_synth')
+
     def __init__(self,
                  intervals,
                  base,
@@ -404,17 +1383,17 @@ class Chord(Event):
                  tie=False,
                  staccato=False,
                  transpose=0,
-                 scale=TonicScale(),
+                 scale=chromatic_scale,
                  synth=None):
         super(Chord, self).__init__(transpose=transpose, scale=scale)
         self._intervals = list(sorted(intervals))
-        self._base = base
+        self._base = sys.intern(base) if isinstance(base, str) else base
         self._duration = duration
         self._extent = duration if extent is None else extent
         self._amplitude = amplitude
         self._tie = tie
         self._staccato = staccato
-        self._synth = synth
+        self._synth = None if synth is None else sys.intern(synth)
         if symbol is not None:
             self.create_symbol(symbol)
 
@@ -435,10 +1414,11 @@ class Chord(Event):
                                         self._duration)
 
     def rotate(self, n):
-        self._intervals = rotate(self._intervals, n)
-        if np.any(np.array(self.get_pitches()) < min_pitch()) or np.any(np.array(self.get_pitches()) > max_pitch()):
-            raise UserWarning("pitches out of range: {}".format(self.get_pitches()))
-        return self
+        """a copy with the n-th inversion of the intervals (the chord itself is not changed, see Event.replace)"""
+        chord = self.replace(intervals=rotate(self._intervals, n))
+        if np.any(np.array(chord.get_pitches()) < min_pitch()) or np.any(np.array(chord.get_pitches()) > max_pitch()):
+            raise UserWarning("pitches out of range: {}".format(chord.get_pitches()))
+        return chord
 
     def get_pitches(self):
         return [i + to_MIDI_pitch(self._base) for i in self._intervals]
@@ -449,35 +1429,14 @@ class Chord(Event):
     def is_transposable(self):
         return True
 
-    def extent(self):
+    def compute_extent(self):
         return Event.time_interval(self._extent)
 
-    def write(self, file=None):
-        if file is None:
-                file = Event._output_file
-        transpose_list = [(self._transpose, self._scale)] + self._transpose_list
-        duration = Event.time_interval(self._duration)
-        if self._staccato:
-            duration = 0.01
-        for interval in self._intervals:
-            pitch = to_MIDI_pitch(self._base) + interval
-            for transpose, scale in transpose_list:
-                scale_degree = scale.get_scale_degree(pitch=pitch)
-                pitch -= scale.get_interval(scale_degree=scale_degree)
-                pitch += scale.get_interval(scale_degree=scale_degree + transpose)
-            if self._synth is not None:
-                Event.write_indent(file)
-                print("use_synth {}".format(self._synth),
-                      file=file)
-            Event.write_indent(file)
-            print("play {}, attack: 0.01, decay: {}, sustain: 0.1, release: 0.1, amp: {}".format(pitch,
-                                                                                                 duration,
-                                                                                                 self._amplitude),
-                  file=file)
-
 
 class Tone(Chord):
 
+    __slots__ = ()
+
     def __init__(self, pitch,
                  duration='1/4',
                  extent=None,
@@ -486,7 +1445,7 @@ class Tone(Chord):
                  tie=False,
                  staccato=False,
                  transpose=0,
-                 scale=TonicScale(),
+                 scale=chromatic_scale,
                  synth=None):
         super(Tone, self).__init__(base=pitch,
                                    intervals=[0],
@@ -511,10 +1470,12 @@ class Tone(Chord):
 
 class Sound(Event):
 
+    __slots__ = ('_extent', '_sound', '_add_code')
+
     def __init__(self, sound, extent='1/4', symbol=None, add_code=""):
-        super(Sound, self).__init__(transpose=0, scale=TonicScale())
+        super(Sound, self).__init__(transpose=0, scale=chromatic_scale)
         self._extent = extent
-        self._sound = sound
+        self._sound = sys.intern(sound)
         self._add_code = add_code
         if symbol is not None:
             self.create_symbol(symbol)
@@ -525,20 +1486,17 @@ class Sound(Event):
     def is_atomic(self):
         return True
 
-    def extent(self):
+    def compute_extent(self):
         return Event.time_interval(self._extent)
 
-    def write(self, file=None):
-        if file is None:
-                file = Event._output_file
-        Event.write_indent(file)
-        print("sample {}{}".format(self._sound, self._add_code), file=file)
 
 class Beat(Sound):
     """
     Possible sounds are: "snare", "tab", "kick", "hh_c", "hh_o", "ride"
     """
 
+    __slots__ = ('_amplitude',)
+
     sounds = {
         "snare": ":drum_snare_soft",
         "tab": ":tabla_ghe1",
@@ -558,16 +1516,13 @@ class Beat(Sound):
     def __repr__(self):
         return "beat:{}:{},{}".format(self._sound, self._extent, self._amplitude)
 
-    def write(self, file=None):
-        if file is None:
-                file = Event._output_file
-        Event.write_indent(file)
-        print("sample {}, amp: {}".format(self._sound, self._amplitude), file=file)
-
 
 class Rest(Event):
+
+    __slots__ = ('_extent',)
+
     def __init__(self, extent='1/4', symbol=None):
-        super(Rest, self).__init__(transpose=0, scale=TonicScale())
+        super(Rest, self).__init__(transpose=0, scale=chromatic_scale)
         self._extent = extent
         if symbol is not None:
             self.create_symbol(symbol)
@@ -578,12 +1533,9 @@ class Rest(Event):
     def is_atomic(self):
         return True
 
-    def extent(self):
+    def compute_extent(self):
         return Event.time_interval(self._extent)
 
-    def write(self, file=None):
-        pass
-
 
 class Sequence(Event):
 
@@ -596,19 +1548,30 @@ class Sequence(Event):
     # for x in Sequence.flatten(x):
     #     print(x)
     @staticmethod
-    def flatten(sequence):
+    def flatten(sequence, expand_sequences=True):
         for event in sequence:
-            if isinstance(event, collections.Iterable) and not isinstance(event, (str, bytes)):
-                yield from Sequence.flatten(event)
-            elif isinstance(event, Sequence):
+            if isinstance(event, collections.abc.Iterable) and not isinstance(event, (str, bytes)):
+                yield from Sequence.flatten(event, expand_sequences=expand_sequences)
+            elif isinstance(event, Sequence) and expand_sequences:
                 yield from event._sequence
             else:
                 yield event
 
-    def __init__(self, sequence, symbol=None, transpose=0, scale=TonicScale(), make_deepcopy=True):
+    def __init__(self, sequence, symbol=None, transpose=0, scale=chromatic_scale, make_deepcopy=False):
         super(Sequence, self).__init__(transpose=transpose, scale=scale)
-        # self._sequence = Sequence.flatten(sequence) # this triggers the bug from above on multiple iterations through sequence
-        self._sequence = list(Sequence.flatten(sequence))
+        # self._sequence = Sequence.flatten(sequence)
+        # (this triggers the bug from above on multiple iterations through sequence)
+        self._sequence = []
+        # (begin, end) of the sub-sequences that were flattened into this one
+        self._parts = []
+        for event in Sequence.flatten(sequence, expand_sequences=False):
+            if isinstance(event, Sequence):
+                offset = len(self._sequence)
+                self._parts.append((offset, offset + len(event._sequence)))
+                self._parts += [(offset + begin, offset + end) for begin, end in event._parts]
+                self._sequence += event._sequence
+            else:
+                self._sequence.append(event)
         if make_deepcopy:
             for i in range(len(self._sequence)):
                 self._sequence[i] = deepcopy(self._sequence[i])
@@ -633,34 +1596,147 @@ class Sequence(Event):
     def get_sequence(self):
         return self._sequence
 
-    def extent(self):
+    def compute_extent(self):
         extent = 0
         for event in self._sequence:
             extent += event.extent()
         return extent
 
+    def has_threads(self):
+        return any(event.has_threads() for event in self._sequence)
+
+    @rendering
     def write(self, file=None):
         if file is None:
-                file = Event._output_file
-        tie_extent = 0
-        flat_sequence = list(self._sequence)
-        for i in range(len(flat_sequence)):
-            event = flat_sequence[i]
-            if isinstance(event, Tone) \
-                    and event._tie \
-                    and i < len(flat_sequence) - 1 \
-                    and isinstance(flat_sequence[i+1], Tone) \
-                    and to_MIDI_pitch(flat_sequence[i+1]._pitch) == to_MIDI_pitch(event._pitch):
-                tie_extent += event.extent()
+                file = Event.context()._output_file
+        # Loops and Symbols are written as function calls, everything in between is compiled
+        transpose_list = [(self._transpose, self._scale)] + list(Event.context()._transpose_list)
+        sequence = self._sequence
+        # count the candidates for sharing by content first to know which of them occur more than once
+        shared = collections.defaultdict(list)
+        counts = collections.Counter()
+        context = Event.context()
+        if Event._hash_consing:
+            candidates = list(self.shared_parts())
+            if candidates:
+                ids = {}
+                contents = context._contents
+                chain = Timeline.transposition(transpose_list)[0]
+                environment = (context._beat, chain, tuple(scale._tonic_pitch for _, scale in chain))
+                environment = contents.setdefault(environment, len(contents))
+                content = [None] * len(sequence)
+                for begin, end in candidates:
+                    for idx in range(begin, end):
+                        if content[idx] is None:
+                            content[idx] = Sequence.content_id(sequence[idx], ids, contents)
+                for begin, end in candidates:
+                    key = (environment, tuple(content[begin:end]))
+                    shared[begin].append((end, key))
+                    counts[key] += 1
+        part = []
+        idx = 0
+        while idx < len(sequence):
+            event = sequence[idx]
+            # use the longest shared part starting here
+            symbol = None
+            for end, key in sorted(shared[idx], reverse=True) if idx in shared else ():
+                if counts[key] > 1 or key in context._shared_parts:
+                    symbol = Sequence.shared_symbol(key, sequence[idx:end], transpose_list)
+                    if symbol is not None:
+                        break
+            threads = event.has_threads()
+            if isinstance(event, (Loop, Symbol)) or symbol is not None or threads:
+                if part:
+                    Timeline.compile_sequence(part, transpose_list).write(file)
+                    part = []
+                if symbol is not None:
+                    Event.emit(file, "call", context._symbols[symbol][0], symbol)
+                    idx = end
+                    continue
+                if threads:
+                    with transposed(self):
+                        event.write(file=file)
+                else:
+                    event.write(file=file)
+            else:
+                part.append(event)
+            idx += 1
+        if part:
+            Timeline.compile_sequence(part, transpose_list).write(file)
+
+    @staticmethod
+    def shared_symbol(key, events, transpose_list):
+        """
+        The symbol of the function playing events (defined on first use) or None if they are too small to be shared.
+        The events are compiled only once for all parts with the same key (see Sequence.content_id).
+        """
+        shared_parts = Event.context()._shared_parts
+        if key not in shared_parts:
+            timeline = Timeline.compile_sequence(events, transpose_list)
+            if len(timeline) < Event._hash_consing_min_records:
+                shared_parts[key] = None
+            else:
+                # parts with different keys but equal content share the function
+                symbol = shared_parts[key] = "shared_" + timeline.digest()[:16]
+                if symbol not in Event.context()._symbols:
+                    Event.add_symbol(symbol, "function_" + symbol, timeline.write, timeline.extent())
+        return shared_parts[key]
+
+    @staticmethod
+    def content_id(event, ids, contents):
+        """
+        Small int for the content of event, interned in 'contents' (see RenderContext): events with the same content id
+        compile to the same records at the same onset and transposition. 'ids' caches the content ids of the events
+        that are not atomic by id(event).
+        """
+        transpose = None if event._transpose == 0 else (event._transpose, event._scale, event._scale._tonic_pitch)
+        # atomic events are cheaper to intern again than to cache
+        if isinstance(event, Chord):
+            content = (type(event), transpose, tuple(event._intervals), event._base, event._duration, event._extent,
+                       event._amplitude, event._tie, event._staccato, event._synth)
+        elif isinstance(event, Beat):
+            content = (Beat, event._extent, event._sound, event._amplitude)
+        elif isinstance(event, Sound):
+            content = (Sound, event._extent, event._sound, event._add_code)
+        elif isinstance(event, Rest):
+            content = (Rest, event._extent)
+        else:
+            content_id = ids.get(id(event))
+            if content_id is not None:
+                return content_id
+            if isinstance(event, Transposed):
+                content = (Transposed, transpose, Sequence.content_id(event._event, ids, contents))
+            elif isinstance(event, (Sequence, Parallel)):
+                events = event.get_sequence() if isinstance(event, Sequence) else event._block
+                content = (type(event), transpose, tuple(Sequence.content_id(e, ids, contents) for e in events))
+            else:
+                # everything else is only equal to itself
+                content = (type(event), event)
+            content_id = ids[id(event)] = contents.setdefault(content, len(contents))
+            return content_id
+        return contents.setdefault(content, len(contents))
+
+    def shared_parts(self):
+        """(begin, end) of all parts that can be written as shared functions (see Event.set_hash_consing)"""
+        sequence = self._sequence
+        parts = set(self._parts)
+        parts.update((idx, idx + 1) for idx, event in enumerate(sequence) if isinstance(event, (Parallel, Transposed)))
+        if not parts:
+            return
+        # running totals of the estimated number of records and of the events that cannot be compiled
+        sizes = [0]
+        sizes.extend(itertools.accumulate(len(e._intervals) if isinstance(e, Chord) else 1 if e.is_atomic() else
+                                          Event._hash_consing_min_records for e in sequence))
+        calls = [0]
+        calls.extend(itertools.accumulate(isinstance(e, (Loop, Symbol)) or e.has_threads() for e in sequence))
+        for begin, end in sorted(parts):
+            # skip parts that are obviously too small, contain function calls, or have ties across their boundaries
+            if sizes[end] - sizes[begin] < Event._hash_consing_min_records or calls[end] > calls[begin]:
                 continue
-            if tie_extent > 0:
-                event._duration = tie_extent + Event.time_interval(event._duration)
-                event._extent = tie_extent + Event.time_interval(event._extent)
-                tie_extent = 0
-            with transposed(event, self):
-                event.write(file=file)
-                if event.is_atomic() and event.extent() > 0:
-                    Event.wait(time=event.extent(), file=file)
+            if (begin > 0 and isinstance(sequence[begin - 1], Tone) and sequence[begin - 1]._tie) or \
+                    (isinstance(sequence[end - 1], Tone) and sequence[end - 1]._tie):
+                continue
+            yield begin, end
 
 
 class Measure(Sequence):
@@ -669,30 +1745,74 @@ class Measure(Sequence):
                  extent,
                  unit='b',
                  symbol=None,
-                 make_deepcopy=True,
+                 make_deepcopy=False,
                  nested_idx=(1,),
-                 amplitude=lambda nested_idx: 0.05 + 0.95 * np.exp(-metrical_grid(nested_idx) / 3)):
+                 amplitude=lambda nested_idx: metrical_weight(metrical_grid(nested_idx))):
         if isinstance(events, (str, Event)):
-            e = Event.parse(events)
-            if make_deepcopy:
-                e = deepcopy(e)
-            if e.is_atomic():
-                e._extent = str(extent)+unit
-            else:
-                raise UserWarning("Don't know how to handle non-atomic event {} in measure".format(e))
-            if isinstance(e, Chord):
-                e._duration = str(extent)+unit
-            if isinstance(e, (Chord, Beat)):
-                e._amplitude *= amplitude(nested_idx=nested_idx)
-            sequence = [e]
+            sequence = [Measure.leaf(events, extent, unit, amplitude(nested_idx=nested_idx))]
+            parts = []
         else:
-            sequence = []
+            # the nested parts use the default amplitude
+            extents, depths, sequence, parts = Measure.grid(events, extent, level=len(nested_idx),
+                                                            depth=metrical_grid(nested_idx))
+            # leaves at the same depth with the same event and extent are the same
+            weights = {depth: metrical_weight(depth) for depth in np.unique(depths).tolist()}
+            leaves = {}
+            for idx, (e, part_extent, depth) in enumerate(zip(sequence, extents.tolist(), depths.tolist())):
+                key = (e if isinstance(e, str) else id(e), part_extent, depth)
+                try:
+                    sequence[idx] = leaves[key]
+                except KeyError:
+                    sequence[idx] = leaves[key] = Measure.leaf(e, part_extent, unit, weights[depth])
+        super(Measure, self).__init__(sequence, symbol=None, make_deepcopy=make_deepcopy)
+        self._parts = parts
+        if symbol is not None:
+            self.create_symbol(symbol)
+
+    @staticmethod
+    def leaf(event, extent, unit, weight):
+        """the atomic event of a leaf in the grid with the given extent and weight (multiplied to its amplitude)"""
+        e = Event.parse(event)
+        if not e.is_atomic():
+            raise UserWarning("Don't know how to handle non-atomic event {} in measure".format(e))
+        attributes = {"extent": str(extent)+unit}
+        if isinstance(e, Chord):
+            attributes["duration"] = str(extent)+unit
+        if isinstance(e, (Chord, Beat)):
+            attributes["amplitude"] = e._amplitude * weight
+        return e.replace(**attributes).flyweight()
+
+    @staticmethod
+    def grid(events, extent, level=1, depth=0):
+        """
+        Flatten a nested rhythm in one pass. Returns the extents and metrical depths (see metrical_grid) of all leaves
+        as arrays, the leaves themselves and the (begin, end) ranges of all nested parts (including single leaves).
+        """
+        extents = []
+        depths = []
+        leaves = []
+        parts = []
+
+        def visit(events, extent, level, depth):
             part_extent = extent
             if events:
                 part_extent /= len(events)
             for idx, e in enumerate(events):
-                sequence.append(Measure(e, part_extent, unit=unit, nested_idx=list(nested_idx) + [idx]))
-        super(Measure, self).__init__(sequence, symbol=symbol, make_deepcopy=make_deepcopy)
+                e_depth = level if idx > 0 else depth
+                begin = len(leaves)
+                if isinstance(e, (str, Event)):
+                    parts.append((begin, begin + 1))
+                    leaves.append(e)
+                    extents.append(part_extent)
+                    depths.append(e_depth)
+                else:
+                    part_idx = len(parts)
+                    parts.append(None)
+                    visit(e, part_extent, level + 1, e_depth)
+                    parts[part_idx] = (begin, len(leaves))
+
+        visit(events, extent, level, depth)
+        return np.array(extents), np.array(depths, dtype=int), leaves, parts
 
 
 class Parallel(Event):
@@ -706,8 +1826,8 @@ class Parallel(Event):
         elif isinstance(event, Loop):
             raise UserWarning("Cannot parallelize Loop event {}".format(event))
         elif isinstance(event, Parallel):
-            for e in event._block:
-                yield from Parallel.flatten(event=e, onset=onset)
+            # voices are sorted by onset, so they can be merged
+            yield from heapq.merge(*[Parallel.flatten(event=e, onset=onset) for e in event._block], key=itemgetter(1))
         elif isinstance(event, Sequence):
             new_onset = onset
             for e in event.get_sequence():
@@ -719,9 +1839,13 @@ class Parallel(Event):
         else:
             raise UserWarning("Don't know how to handle event {} in parallelization".format(event))
 
-    def __init__(self, block, symbol=None, transpose=0, scale=TonicScale(), make_deepcopy=True):
+    def __init__(self, block, symbol=None, transpose=0, scale=chromatic_scale, make_deepcopy=False, threads=None):
+        """
+        With 'threads' each voice is written as its own "in_thread" block (default: see Event.set_parallel_threads)
+        """
         super(Parallel, self).__init__(transpose=transpose, scale=scale)
-        self._block = block
+        self._block = list(block)
+        self._threads = threads
         if make_deepcopy:
             for i in range(len(self._block)):
                 self._block[i] = deepcopy(self._block[i])
@@ -743,31 +1867,38 @@ class Parallel(Event):
     def is_transposable(self):
         return True
 
-    def extent(self):
+    def compute_extent(self):
         extent = 0
         for event in self._block:
             extent = max(extent, event.extent())
         return extent
 
+    def has_threads(self):
+        threads = Event._parallel_threads if self._threads is None else self._threads
+        # voices with threads cannot be interleaved, so their Parallel needs threads, too
+        return threads or any(event.has_threads() for event in self._block)
+
+    @rendering
     def write(self, file=None):
+        if not self.has_threads():
+            return super(Parallel, self).write(file)
         if file is None:
-                file = Event._output_file
-        time = 0
-        max_offset = 0
-        for event, onset, offset in sorted(list(Parallel.flatten(self)), key=lambda x: x[1]):
-            max_offset = max(max_offset, offset)
-            if onset > time:
-                Event.wait(time=onset - time, file=file)
-                time = onset
-            with transposed(event, self):
+                file = Event.context()._output_file
+        # the voices run in their own threads with local sleeps, the Parallel as a whole waits for its extent
+        context = Event.context()
+        for event in self._block:
+            Event.emit(file, "in_thread")
+            context._indent += 1
+            with transposed(self):
                 event.write(file=file)
-        if max_offset > time:
-            Event.wait(time=max_offset - time, file=file)
+            context._indent -= 1
+            Event.emit(file, "end")
+        Event.wait(round(self.extent(), 10), file)
 
 
 class Transposed(Event):
 
-    def __init__(self, event, transpose, scale=TonicScale(), make_deepcopy=False):
+    def __init__(self, event, transpose, scale=chromatic_scale, make_deepcopy=False):
         super(Transposed, self).__init__(transpose=transpose, scale=scale)
         if not event.is_transposable():
             raise UserWarning("Cannot transpose event {}".format(event))
@@ -785,40 +1916,47 @@ class Transposed(Event):
     def is_transposable(self):
         return True
 
-    def extent(self):
+    def compute_extent(self):
         return self._event.extent()
 
+    def has_threads(self):
+        return self._event.has_threads()
+
+    @rendering
     def write(self, file=None):
-        if file is None:
-                file = Event._output_file
-        with transposed(self._event, self):
-            self._event.write(file)
+        if not self.has_threads():
+            return super(Transposed, self).write(file)
+        with transposed(self):
+            self._event.write(file=file)
 
 
 class Symbol(Event):
 
     def __init__(self, symbol):
-        super(Symbol, self).__init__(transpose=0, scale=TonicScale())
+        super(Symbol, self).__init__(transpose=0, scale=chromatic_scale)
         self._symbol = symbol
 
-    def extent(self):
-        return Event._symbols[self._symbol][2]
+    def compute_extent(self):
+        return Event.context()._symbols[self._symbol][2]
 
+    @rendering
     def write(self, file=None):
         if file is None:
-                file = Event._output_file
-        Event.write_indent(file)
-        print("{} # {}".format(Event._symbols[self._symbol][0], self._symbol), file=file)
+                file = Event.context()._output_file
+        Event.emit(file, "call", Event.context()._symbols[self._symbol][0], self._symbol)
 
 
 class Loop(Event):
 
-    def __init__(self, event, symbol=None, repeat=None, active=True, transpose=0, scale=TonicScale()):
+    @rendering
+    def __init__(self, event, symbol=None, repeat=None, active=True, transpose=0, scale=chromatic_scale):
         super(Loop, self).__init__(transpose=transpose, scale=scale)
         self._symbol = symbol if symbol is not None else Event.random_string()
         self._repeat = repeat
-        with transposed(event, self):
-            event.create_symbol(self._symbol)
+        if transpose != 0 and event.is_transposable():
+            event = Transposed(event, transpose=transpose, scale=scale)
+        self._event = event
+        event.create_symbol(self._symbol)
         self._symbol_event = Symbol(self._symbol)
         if active:
             Event.add_loop(self._symbol)
@@ -826,31 +1964,270 @@ class Loop(Event):
     def __repr__(self):
         return "Loop("+self._symbol+")"
 
-    def extent(self):
+    def compute_extent(self):
         if self._repeat is None:
             return None
         else:
             return self._repeat * self._symbol_event.extent()
 
+    @rendering
     def write(self, file=None):
         if file is None:
-                file = Event._output_file
-        Event.write_indent(file)
+                file = Event.context()._output_file
         if self._repeat is None:
-            print("while loop_test('{}')".format(self._symbol), file=file)
+            Event.emit(file, "while", self._symbol)
         else:
-            print("{}.times do".format(self._repeat), file=file)
-        Event._indent += 1
-        Event.write_indent(file)
-        print('''puts "restart {}loop '{}'"'''.format(
+            Event.emit(file, "times", self._repeat)
+        Event.context()._indent += 1
+        Event.emit(file, "line", '''puts "restart {}loop '{}'"'''.format(
             ('' if self._repeat is None else "{}-time-".format(self._repeat)),
-            self._symbol),
-            file=file)
+            self._symbol))
         self._symbol_event.write(file)
-        Event._indent -= 1
-        Event.write_indent(file)
-        print("end", file=file)
+        Event.context()._indent -= 1
+        Event.emit(file, "end")
+
+
+
+class Timeline:
+    """
+    Flat representation of all notes and samples of an event, sorted by onset. Each record holds onset and offset (in
+    sec), the MIDI pitch (-1 for samples), amplitude (NaN if none is specified), the duration of the sounding note, and
+    indices into the lists of synth and sample names (-1 if not used).
+    """
+
+    dtype = np.dtype([('onset', 'f8'),
+                      ('offset', 'f8'),
+                      ('pitch', 'i2'),
+                      ('amplitude', 'f8'),
+                      ('duration', 'f8'),
+                      ('synth', 'i2'),
+                      ('sample', 'i2')])
+
+    # onsets are rounded to this many digits (in sec) when compiled and merged, so simultaneous records are in the order
+    # of their voices regardless of the rounding errors of the sums they were computed from
+    onset_digits = 9
+
+    @staticmethod
+    def compile(event):
+        """compile the event into a Timeline"""
+        transposition = Timeline.transposition(Event.context()._transpose_list)
+        return Timeline._compile(lambda synths, samples: Timeline._records(event, 0, transposition, synths, samples))
+
+    @staticmethod
+    def compile_sequence(events, transpose_list=()):
+        """compile a list of events to be played one after the other"""
+        transposition = Timeline.transposition(transpose_list)
+        return Timeline._compile(lambda synths, samples: Timeline._sequence_records(events, 0, transposition,
+                                                                                    synths, samples))
+
+    @staticmethod
+    def transposition(transpose_list):
+        """
+        Return (chain, table) for a list of (transpose, scale) pairs (innermost first), where chain only contains the
+        pairs that actually transpose and table maps the 128 MIDI pitches through all of them.
+        """
+        chain = tuple((transpose, scale) for transpose, scale in transpose_list if transpose != 0)
+        return chain, Timeline.transposition_table(chain)
+
+    @staticmethod
+    def transposed(transposition, event):
+        """the transposition within event, i.e. with the transposition of event applied first"""
+        if event._transpose == 0:
+            return transposition
+        chain = ((event._transpose, event._scale),) + transposition[0]
+        return chain, Timeline.transposition_table(chain)
+
+    @staticmethod
+    def transposition_table(chain):
+        """
+        Lookup table composed of the transposition tables of all pairs in chain, cached in the current RenderContext
+        as long as the tonics of the scales do not change.
+        """
+        tables = Event.context()._transposition_tables
+        tonics = tuple(scale._tonic_pitch for _, scale in chain)
+        cached = tables.get(chain)
+        if cached is not None and cached[0] == tonics:
+            return cached[1]
+        if chain:
+            table = Timeline.transposition_table(chain[:-1])
+            transpose, scale = chain[-1]
+            if table.min() >= 0 and table.max() < 128:
+                table = scale.transposition_table(transpose)[table]
+            else:
+                table = scale.transpose_pitches(table, transpose)
+        else:
+            table = np.arange(128)
+        tables[chain] = (tonics, table)
+        return table
+
+    @staticmethod
+    def transpose_pitch(pitch, transposition):
+        chain, table = transposition
+        if 0 <= pitch < 128:
+            return int(table[pitch])
+        # pitches outside the MIDI range are transposed step by step
+        for transpose, scale in chain:
+            pitch = int(scale.transpose_pitches(pitch, transpose))
+        return pitch
+
+    @staticmethod
+    def _compile(records):
+        synths = {}
+        samples = {}
+        offsets = []
+        records = np.fromiter(Timeline._returning(records(synths, samples), offsets), dtype=Timeline.dtype)
+        records['onset'] = np.round(records['onset'], Timeline.onset_digits)
+        return Timeline(records=records, extent=round(offsets[0], Timeline.onset_digits), synths=list(synths),
+                        samples=list(samples))
+
+    @staticmethod
+    def _merge_key(record):
+        return round(record[0], Timeline.onset_digits)
+
+    @staticmethod
+    def _returning(records, offsets):
+        offsets.append((yield from records))
+
+    @staticmethod
+    def _records(event, onset, transposition, synths, samples, duration=None, extent=None):
+        # yields records in order of their onset and returns the offset of the event
+        if extent is None and event.is_atomic():
+            extent = event.extent()
+        if isinstance(event, Chord):
+            if event._staccato:
+                duration = 0.01
+            elif duration is None:
+                duration = Event.time_interval(event._duration)
+            synth = -1 if event._synth is None else synths.setdefault(event._synth, len(synths))
+            transposition = Timeline.transposed(transposition, event)
+            base = to_MIDI_pitch(event._base)
+            for interval in event._intervals:
+                pitch = Timeline.transpose_pitch(base + interval, transposition)
+                yield (onset, onset + extent, pitch, event._amplitude, duration, synth, -1)
+        elif isinstance(event, Beat):
+            yield (onset, onset + extent, -1, event._amplitude, 0, -1, samples.setdefault(event._sound, len(samples)))
+        elif isinstance(event, Sound):
+            yield (onset, onset + extent, -1, np.nan, 0, -1,
+                   samples.setdefault(event._sound + event._add_code, len(samples)))
+        elif isinstance(event, Rest):
+            pass
+        elif isinstance(event, Transposed):
+            return (yield from Timeline._records(event._event, onset,
+                                                 Timeline.transposed(transposition, event),
+                                                 synths, samples))
+        elif isinstance(event, Sequence):
+            return (yield from Timeline._sequence_records(event.get_sequence(), onset,
+                                                          Timeline.transposed(transposition, event),
+                                                          synths, samples))
+        elif isinstance(event, Parallel):
+            # each voice is already sorted, so merging keeps only one pending record per voice
+            offsets = [onset]
+            transposition = Timeline.transposed(transposition, event)
+            yield from heapq.merge(*[Timeline._returning(Timeline._records(e, onset, transposition, synths, samples),
+                                                         offsets)
+                                     for e in event._block],
+                                   key=Timeline._merge_key)
+            return max(offsets)
+        elif isinstance(event, Loop) and event._repeat is not None:
+            # the transposition of the loop is part of its event
+            for _ in range(event._repeat):
+                onset = yield from Timeline._records(event._event, onset, transposition, synths, samples)
+            return onset
+        else:
+            raise UserWarning("Cannot compile event {}".format(event))
+        return onset + extent
+
+    @staticmethod
+    def _sequence_records(events, onset, transposition, synths, samples):
+        # yields records in order of their onset and returns the offset of the sequence
+        tie_extent = 0
+        for idx, event in enumerate(events):
+            if isinstance(event, Tone) \
+                    and event._tie \
+                    and idx < len(events) - 1 \
+                    and isinstance(events[idx + 1], Tone) \
+                    and to_MIDI_pitch(events[idx + 1]._base) == to_MIDI_pitch(event._base):
+                tie_extent += event.extent()
+                continue
+            if tie_extent > 0:
+                onset = yield from Timeline._records(event, onset, transposition, synths, samples,
+                                                     duration=tie_extent + Event.time_interval(event._duration),
+                                                     extent=tie_extent + event.extent())
+                tie_extent = 0
+            else:
+                onset = yield from Timeline._records(event, onset, transposition, synths, samples)
+        return onset
+
+    def __init__(self, records, extent, synths=(), samples=()):
+        self._records = records
+        self._extent = extent
+        self._synths = list(synths)
+        self._samples = list(samples)
+
+    def __repr__(self):
+        return "Timeline({} records, {} sec)".format(len(self._records), self._extent)
+
+    def __len__(self):
+        return len(self._records)
 
+    def get_records(self):
+        return self._records
+
+    def get_synths(self):
+        return self._synths
+
+    def get_samples(self):
+        return self._samples
+
+    @staticmethod
+    def sample_name(sample):
+        """name of a sample of a Timeline without the code added to it by its Sound (see Sound)"""
+        return sample.partition(",")[0].strip()
+
+    def extent(self):
+        return self._extent
+
+    def digest(self):
+        """hash of the content (independent of where the Timeline came from)"""
+        h = hashlib.sha1(self._records.tobytes())
+        h.update(repr((self._extent, self._synths, self._samples)).encode())
+        return h.hexdigest()
+
+    def slice(self, begin, end):
+        """all records with onset in [begin, end), shifted to start at zero"""
+        onsets = self._records['onset']
+        records = self._records[np.searchsorted(onsets, begin):np.searchsorted(onsets, end)].copy()
+        records['onset'] -= begin
+        records['offset'] -= begin
+        return Timeline(records=records, extent=end - begin, synths=self._synths, samples=self._samples)
+
+    @rendering
+    def write(self, file=None):
+        if file is None:
+                file = Event.context()._output_file
+        indent = Event.context()._indent
+        time = 0
+        # emit in blocks of records to keep the number of pending instructions bounded
+        for begin in range(0, len(self._records), 2 ** 12):
+            instructions = []
+            add = instructions.append
+            records = self._records[begin:begin + 2 ** 12].tolist()
+            for onset, offset, pitch, amplitude, duration, synth, sample in records:
+                if onset > time:
+                    add((indent, "sleep", (round(onset - time, 10),)))
+                    time = onset
+                if sample >= 0:
+                    if amplitude != amplitude:
+                        add((indent, "sample", (self._samples[sample],)))
+                    else:
+                        add((indent, "sample_amp", (self._samples[sample], amplitude)))
+                else:
+                    if synth >= 0:
+                        add((indent, "use_synth", (self._synths[synth],)))
+                    add((indent, "play", (pitch, duration, amplitude)))
+            Event.emit_all(file, instructions)
+        if self._extent > time:
+            Event.emit(file, "sleep", round(self._extent - time, 10))
 
 class TimeSeriesModel:
 
@@ -921,7 +2298,8 @@ class FactorModel(TimeSeriesModel):
             self._weights = weights
         else:
             if weights != () or factors != ():
-                raise UserWarning("Cannot handle both 'weight_factors' and 'weights' and 'factors' specified separately")
+                raise UserWarning("Cannot handle both 'weight_factors' and 'weights' and 'factors' specified "
+                                  "separately")
             self._weights, self._factors = zip(*weight_factors)
 
     def log_probability(self, history, event):
@@ -1060,7 +2438,7 @@ class ScaleDistribution(PitchDistribution):
 
     def __init__(self, scale, epsilon=0):
         self._scale = scale
-        distribution = np.array([(1. if self._scale.is_in_scale(pitch) else 0.) for pitch in pitch_range()])
+        distribution = self._scale.is_in_scale_array(pitch_range()).astype(float)
         distribution /= distribution.sum()
         super(ScaleDistribution, self).__init__(distribution, epsilon)
 
@@ -1156,13 +2534,530 @@ class TestModel(TimeSeriesModel):
                 return 1/len(self._alphabet)
 
 
+def osc_string(string):
+    data = string.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 4)
+
+
+def osc_message(address, *args):
+    """encode an OSC message (arguments may be int, float, str or bytes)"""
+    tags = ","
+    data = []
+    for arg in args:
+        if isinstance(arg, (int, np.integer)) and not isinstance(arg, bool):
+            tags += "i"
+            data.append(struct.pack(">i", arg))
+        elif isinstance(arg, (float, np.floating)):
+            tags += "f"
+            data.append(struct.pack(">f", arg))
+        elif isinstance(arg, str):
+            tags += "s"
+            data.append(osc_string(arg))
+        elif isinstance(arg, bytes):
+            tags += "b"
+            data.append(struct.pack(">i", len(arg)) + arg + b"\0" * (-len(arg) % 4))
+        else:
+            raise UserWarning("Cannot send '{}' (type {}) via OSC".format(arg, type(arg)))
+    return osc_string(address) + osc_string(tags) + b"".join(data)
+
+
+# seconds between the NTP epoch (used by OSC time tags) and the Unix epoch
+NTP_EPOCH_OFFSET = 2208988800
+
+
+def osc_bundle(timestamp, messages):
+    """encode an OSC bundle of encoded messages to be executed at 'timestamp' (as returned by time.time())"""
+    timetag = int((timestamp + NTP_EPOCH_OFFSET) * 2 ** 32)
+    return b"#bundle\0" + struct.pack(">Q", timetag) + \
+        b"".join(struct.pack(">i", len(message)) + message for message in messages)
+
+
+def osc_decode(packet):
+    """decode an OSC packet into a list of (address, arguments) for all messages it contains"""
+    return [(address, args) for timestamp, address, args in osc_decode_timed(packet)]
+
+
+def osc_decode_timed(packet, timestamp=None):
+    """like osc_decode but returns (timestamp, address, arguments) with the timestamp of the bundle (None if none)"""
+    def read_string(pos):
+        end = packet.index(b"\0", pos)
+        return packet[pos:end].decode(), end + 1 + (-(end + 1) % 4)
+
+    if packet.startswith(b"#bundle\0"):
+        timetag, = struct.unpack_from(">Q", packet, 8)
+        timestamp = timetag / 2 ** 32 - NTP_EPOCH_OFFSET
+        messages = []
+        pos = 16
+        while pos < len(packet):
+            size, = struct.unpack_from(">i", packet, pos)
+            messages += osc_decode_timed(packet[pos + 4:pos + 4 + size], timestamp)
+            pos += 4 + size
+        return messages
+    address, pos = read_string(0)
+    tags, pos = read_string(pos)
+    args = []
+    for tag in tags[1:]:
+        if tag == "i":
+            args.append(struct.unpack_from(">i", packet, pos)[0])
+            pos += 4
+        elif tag == "f":
+            args.append(struct.unpack_from(">f", packet, pos)[0])
+            pos += 4
+        elif tag == "s":
+            arg, pos = read_string(pos)
+            args.append(arg)
+        elif tag == "b":
+            size, = struct.unpack_from(">i", packet, pos)
+            args.append(packet[pos + 4:pos + 4 + size])
+            pos += 4 + size + (-size % 4)
+        else:
+            raise UserWarning("Cannot decode OSC type tag '{}'".format(tag))
+    return [(timestamp, address, args)]
+
+
+def ruby_string(string):
+    return "'" + string.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+class SonicPi:
+    """
+    Sends code to the OSC server of Sonic Pi, which runs it immediately. It can be used instead of a file name in
+    write_song(file=SonicPi()). Older versions of Sonic Pi listen on port 4557 and take a client name as first argument
+    of '/run-code', newer ones use a random port and a token (both can be found in Sonic Pi's log files).
+
+    Code that does not fit into a single UDP packet is sent in chunks of 'chunk_size' characters, which are collected in
+    a global Ruby variable and evaluated once the last one arrived. Chunks are sent 'chunk_interval' seconds apart, so
+    they do not overflow the receive buffer of the server (where they would be dropped).
+    """
+
+    def __init__(self, host="127.0.0.1", port=4557, token=None, client="MusicTreequence", chunk_size=8192,
+                 address="/run-code", chunk_interval=0.002):
+        self._host = host
+        self._port = port
+        self._token = token
+        self._client = client
+        self._chunk_size = chunk_size
+        self._address = address
+        self._chunk_interval = chunk_interval
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._last_digest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._socket.close()
+
+    def send(self, packet):
+        self._socket.sendto(packet, (self._host, self._port))
+
+    def packets(self, code):
+        """the OSC packets for running 'code'"""
+        first_arg = self._client if self._token is None else self._token
+        if len(code) <= self._chunk_size:
+            return [osc_message(self._address, first_arg, code)]
+        chunks = [code[idx:idx + self._chunk_size] for idx in range(0, len(code), self._chunk_size)]
+        key = ruby_string(hashlib.sha1(code.encode()).hexdigest()[:16])
+        store = "(($music_treequence_chunks ||= {{}})[{}] ||= {{}})".format(key, key)
+        packets = [osc_message(self._address, first_arg, "{}[{}] = {}".format(store, idx, ruby_string(chunk)))
+                   for idx, chunk in enumerate(chunks[:-1])]
+        # chunks are run in separate threads, so the last one waits (up to a second) for the others to arrive
+        packets.append(osc_message(self._address, first_arg, "\n".join([
+            "chunks = {}".format(store),
+            "chunks[{}] = {}".format(len(chunks) - 1, ruby_string(chunks[-1])),
+            "100.times {{ break if chunks.size == {}; Kernel.sleep(0.01) }}".format(len(chunks)),
+            "$music_treequence_chunks.delete({})".format(key),
+            "eval((0...{}).map {{ |idx| chunks[idx] }}.join)".format(len(chunks))
+        ])))
+        return packets
+
+    def run_code(self, code, if_changed=False):
+        """send code to Sonic Pi (with 'if_changed=True' only if it differs from the code sent last)"""
+        digest = hashlib.sha1(code.encode()).hexdigest()
+        if if_changed and digest == self._last_digest:
+            return False
+        for idx, packet in enumerate(self.packets(code)):
+            if idx > 0:
+                time.sleep(self._chunk_interval)
+            self.send(packet)
+        self._last_digest = digest
+        return True
+
+
+class Player:
+    """
+    Plays events in real time by sending their notes and samples as time-stamped OSC bundles (one per onset), each
+    'lookahead' seconds before it is due, driven by an asyncio scheduler. Messages are sent to '<prefix>/play' (pitch,
+    duration, amplitude, synth) and '<prefix>/sample' (sample, amplitude), with synth and sample names without their
+    leading colon, by default to Sonic Pi's cue port, where they can be played with something like
+
+        live_loop :music_treequence do
+          use_real_time
+          pitch, duration, amplitude, synth = sync "/osc*/music_treequence/play"
+          use_synth synth.to_sym unless synth.empty?
+          play pitch, sustain: duration, amp: amplitude
+        end
+
+    Lateness (actual minus scheduled send time) of all bundles is recorded, see get_statistics.
+    """
+
+    def __init__(self, host="127.0.0.1", port=4560, lookahead=0.1, prefix="/music_treequence"):
+        self._host = host
+        self._port = port
+        self._lookahead = lookahead
+        self._prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._scheduled = []
+        self._lateness = []
+        self._n_messages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._socket.close()
+
+    def bundles(self, timeline, start):
+        """yield (send time, bundle, number of messages) for each onset of the timeline if it starts at 'start'"""
+        if isinstance(timeline, Event):
+            timeline = Timeline.compile(timeline)
+        # names are sent without the colon of their Sonic Pi symbol
+        synths = [synth.lstrip(":") for synth in timeline.get_synths()]
+        samples = [Timeline.sample_name(sample).lstrip(":") for sample in timeline.get_samples()]
+        records = timeline.get_records()
+        if len(records) == 0:
+            return
+        # records are sorted by onset, so each group of records with the same onset becomes one bundle
+        boundaries = np.flatnonzero(np.diff(records['onset'])) + 1
+        for group in np.split(records, boundaries):
+            messages = []
+            for onset, offset, pitch, amplitude, duration, synth, sample in group.tolist():
+                amplitude = 1. if amplitude != amplitude else amplitude
+                if sample >= 0:
+                    messages.append(osc_message(self._prefix + "/sample", samples[sample], amplitude))
+                else:
+                    messages.append(osc_message(self._prefix + "/play", pitch, duration, amplitude,
+                                                "" if synth < 0 else synths[synth]))
+            timestamp = start + group['onset'][0]
+            yield timestamp - self._lookahead, osc_bundle(timestamp, messages), len(messages)
+
+    async def play(self, timeline, start=None):
+        """play a Timeline (or an event, which is compiled first), starting 'lookahead' seconds from now by default"""
+        if start is None:
+            start = time.time() + self._lookahead
+        for send_time, bundle, n_messages in self.bundles(timeline, start):
+            delay = send_time - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._socket.sendto(bundle, (self._host, self._port))
+            self._scheduled.append(send_time)
+            self._lateness.append(time.time() - send_time)
+            self._n_messages += n_messages
+
+    def run(self, timeline, start=None):
+        """play (see above) without a running event loop"""
+        asyncio.run(self.play(timeline, start=start))
+
+    def get_statistics(self):
+        """
+        Statistics of the bundles sent so far: mean and max lateness, jitter (standard deviation of the lateness) and
+        drift (change of lateness per second of playing time) in seconds.
+        """
+        lateness = np.array(self._lateness)
+        statistics = {"bundles": len(lateness), "messages": self._n_messages}
+        if len(lateness) > 0:
+            statistics.update(mean_lateness=float(lateness.mean()),
+                              max_lateness=float(lateness.max()),
+                              jitter=float(lateness.std()))
+        if len(lateness) > 1 and np.ptp(self._scheduled) > 0:
+            statistics["drift"] = float(np.polyfit(self._scheduled, lateness, 1)[0])
+        return statistics
+
+
+class OSCReceiver:
+    """
+    A local UDP server that records all OSC messages it receives as (arrival time, address, arguments), e.g. as a
+    stand-in for Sonic Pi when testing. Use port=0 to get a free port (see get_address). The time stamps of bundles are
+    available via get_timed_messages.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, port))
+        # check regularly whether the receiver was closed
+        self._socket.settimeout(0.1)
+        self._closed = False
+        self._messages = []
+        self._received = threading.Condition()
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _receive(self):
+        while not self._closed:
+            try:
+                packet = self._socket.recv(1 << 16)
+            except socket.timeout:
+                continue
+            except OSError:
+                # socket was closed
+                return
+            arrival = time.time()
+            with self._received:
+                self._messages += [(arrival, timestamp, address, args)
+                                   for timestamp, address, args in osc_decode_timed(packet)]
+                self._received.notify_all()
+
+    def get_address(self):
+        return self._socket.getsockname()
+
+    def get_messages(self):
+        with self._received:
+            return [(arrival, address, args) for arrival, timestamp, address, args in self._messages]
+
+    def get_timed_messages(self):
+        """all messages as (arrival time, bundle time stamp or None, address, arguments)"""
+        with self._received:
+            return list(self._messages)
+
+    def wait(self, n_messages, timeout=1.):
+        """wait until at least n_messages were received and return all messages received so far"""
+        with self._received:
+            self._received.wait_for(lambda: len(self._messages) >= n_messages, timeout=timeout)
+        return self.get_messages()
+
+    def close(self):
+        self._closed = True
+        self._thread.join(timeout=1.)
+        self._socket.close()
+
+
+def watch(script, interval=0.05, debounce=0.1, arguments=()):
+    """
+    Run a song script whenever it changes (checked every 'interval' seconds; a change is only picked up once the script
+    did not change for 'debounce' seconds). The script runs in this process after Event.reset(), so the library stays
+    loaded, and songs written with write_song are only replaced if their content changes.
+    """
+    def modified():
+        try:
+            stat = os.stat(script)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    last_run = None
+    last_seen = modified()
+    last_change = time.monotonic() - debounce
+    print("watching {} (stop with Ctrl-C)".format(script), file=sys.stderr)
+    try:
+        while True:
+            current = modified()
+            now = time.monotonic()
+            if current != last_seen:
+                last_seen = current
+                last_change = now
+            elif current is not None and current != last_run and now - last_change >= debounce:
+                last_run = current
+                start = time.perf_counter()
+                run_watched(script, arguments)
+                print("ran {} in {:.3f} sec".format(script, time.perf_counter() - start), file=sys.stderr)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_watched(script, arguments=()):
+    """
+    Run a song script once as watch does: after Event.reset(), with songs only replaced if their content changes, and
+    with the switches of Event restored afterwards, so switches removed from the script do not survive to the next run.
+    Exceptions of the script are printed.
+    """
+    settings = {name: copy(getattr(Event, name)) for name in Event._settings}
+    old_argv, old_path = sys.argv, list(sys.path)
+    sys.argv = [script] + list(arguments)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    Event._write_if_changed = True
+    try:
+        Event.reset()
+        runpy.run_path(script, run_name="__main__")
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.argv, sys.path[:] = old_argv, old_path
+        for name, value in settings.items():
+            setattr(Event, name, value)
+
+
+def variant_seed(seed, index):
+    """deterministic seed of the variant with the given index in a batch with the given seed"""
+    return int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+
+
+def render_variant(target, parameters, seed, directory):
+    """
+    Render one variant of a batch into 'directory' (see render_batch) and return its manifest entry. The variant is
+    written in a new RenderContext with the random generators of random and numpy seeded with 'seed', and the switches
+    of Event are restored afterwards, so variants do not depend on which other variants ran in the same process.
+    """
+    entry = {"name": os.path.basename(directory), "parameters": parameters, "seed": seed}
+    os.makedirs(directory, exist_ok=True)
+    settings = {name: copy(getattr(Event, name)) for name in Event._settings}
+    old_cwd, old_argv, old_path = os.getcwd(), sys.argv, list(sys.path)
+    start = time.perf_counter()
+    try:
+        random.seed(seed)
+        np.random.seed(seed)
+        # relative paths written by the variant end up in its directory
+        os.chdir(directory)
+        with RenderContext().activate():
+            Event.reset()
+            if callable(target) or not target.endswith(".py"):
+                if isinstance(target, str):
+                    module, _, name = target.partition(":")
+                    target = getattr(importlib.import_module(module), name or "song")
+                with write_song("song.rb"):
+                    event = target(**parameters)
+                    if isinstance(event, Event):
+                        event.write()
+            else:
+                sys.argv = [target]
+                sys.path.insert(0, os.path.dirname(target))
+                runpy.run_path(target, init_globals={"parameters": dict(parameters)}, run_name="__main__")
+        entry["error"] = None
+    except Exception:
+        entry["error"] = traceback.format_exc()
+    finally:
+        entry["seconds"] = time.perf_counter() - start
+        os.chdir(old_cwd)
+        sys.argv, sys.path[:] = old_argv, old_path
+        for name, value in settings.items():
+            setattr(Event, name, value)
+    entry["files"] = sorted(os.path.relpath(os.path.join(path, file), directory)
+                            for path, _, files in os.walk(directory) for file in files)
+    entry["bytes"] = sum(os.path.getsize(os.path.join(directory, file)) for file in entry["files"])
+    return entry
+
+
+def render_batch(target, grid=None, repeats=1, seed=0, output_dir="batch", workers=None, log=sys.stderr):
+    """
+    Render all combinations of the parameter values in 'grid' (dict mapping names to lists of values), each 'repeats'
+    times with different seeds, in parallel processes ('workers', default: all cores). Each variant is written to its
+    own directory in 'output_dir', which also gets a manifest.json with parameters, seed, time and output size of all
+    variants (returned as dict).
+
+    'target' is either a song script (*.py), which can read its parameters from the global dict 'parameters' and
+    writes its songs relative to the directory of the variant, or a function (or "module:function" name) that is
+    called with the parameters as keyword arguments inside write_song("song.rb") and may return an event to write.
+    """
+    grid = dict(grid or {})
+    output_dir = os.path.abspath(output_dir)
+    if isinstance(target, str) and target.endswith(".py"):
+        if not os.path.isfile(target):
+            raise UserWarning("Song script '{}' does not exist".format(target))
+        target = os.path.abspath(target)
+    combinations = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    tasks = []
+    for parameters in combinations:
+        for _ in range(repeats):
+            index = len(tasks)
+            tasks.append((target, parameters, variant_seed(seed, index),
+                          os.path.join(output_dir, "variant_{:04d}".format(index))))
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    entries = [None] * len(tasks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(render_variant, *task): index for index, task in enumerate(tasks)}
+        for future in concurrent.futures.as_completed(futures):
+            entry = entries[futures[future]] = future.result()
+            if log is not None:
+                print("{} {} in {:.3f} sec ({} bytes)".format(entry["name"], "failed" if entry["error"] else "rendered",
+                                                            entry["seconds"], entry["bytes"]), file=log)
+    manifest = {"target": target if isinstance(target, str) else "{}:{}".format(target.__module__, target.__name__),
+                "grid": grid,
+                "repeats": repeats,
+                "seed": seed,
+                "seconds": time.perf_counter() - start,
+                "variants": entries}
+    with open(os.path.join(output_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def parse_parameter(parameter):
+    """parse "name=value,value,..." into (name, [value, ...]) with values parsed as JSON where possible"""
+    name, separator, values = parameter.partition("=")
+    if not separator or not name:
+        raise argparse.ArgumentTypeError("parameters must be given as name=value,value,... not '{}'".format(parameter))
+    parsed = []
+    for value in values.split(","):
+        try:
+            parsed.append(json.loads(value))
+        except ValueError:
+            parsed.append(value)
+    return name, parsed
+
+
+def main(argv=None):
+    """command line interface (python -m MusicTreequence ...)"""
+    parser = argparse.ArgumentParser(prog="python -m MusicTreequence")
+    commands = parser.add_subparsers(dest="command", required=True)
+    watch_parser = commands.add_parser("watch", help="re-run a song script whenever it changes")
+    watch_parser.add_argument("script")
+    watch_parser.add_argument("arguments", nargs="*",
+                              help="arguments passed on to the script (after '--' if they start with '-')")
+    watch_parser.add_argument("--interval", type=float, default=0.05, help="polling interval in seconds")
+    watch_parser.add_argument("--debounce", type=float, default=0.1,
+                              help="seconds the script has to be unchanged before it is run")
+    batch_parser = commands.add_parser("render-batch", help="render variants of a song in parallel processes")
+    batch_parser.add_argument("target", help="song script (*.py) or function (module:function)")
+    batch_parser.add_argument("--grid", help="JSON file mapping parameter names to lists of values")
+    batch_parser.add_argument("--param", "-p", type=parse_parameter, action="append", default=[],
+                              help="parameter values as name=value,value,... (may be repeated)")
+    batch_parser.add_argument("--repeats", "-n", type=int, default=1, help="variants (with different seeds) per point")
+    batch_parser.add_argument("--seed", type=int, default=0, help="seed from which the seeds of the variants derive")
+    batch_parser.add_argument("--output-dir", "-o", default="batch", help="directory for the variants and manifest")
+    batch_parser.add_argument("--workers", "-j", type=int, help="number of processes (default: all cores)")
+    args = parser.parse_args(argv)
+    if args.command == "watch":
+        watch(args.script, interval=args.interval, debounce=args.debounce, arguments=args.arguments)
+    elif args.command == "render-batch":
+        grid = {}
+        if args.grid is not None:
+            with open(args.grid) as file:
+                grid.update(json.load(file))
+        grid.update(args.param)
+        manifest = render_batch(args.target, grid=grid, repeats=args.repeats, seed=args.seed,
+                                output_dir=args.output_dir, workers=args.workers)
+        failed = sum(entry["error"] is not None for entry in manifest["variants"])
+        print("rendered {} variants in {:.3f} sec ({} failed), manifest in {}".format(
+            len(manifest["variants"]), manifest["seconds"], failed, os.path.join(args.output_dir, "manifest.json")),
+            file=sys.stderr)
+        return 1 if failed else 0
+    return 0
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # use the importable module, so that scripts importing MusicTreequence share its state
+        from MusicTreequence import main
+        sys.exit(main())
     with io.StringIO() as file:
         # create events and write to string-file
         Event.set_beat("80bpm")
         print("# main function", file=file)
         print("def song", file=file)
-        Event._indent += 1
+        Event.context()._indent += 1
         ## measures
         m = Measure(['d', 'd', 'f', ['g_', 'g_', "d'"], 'a', 'g', 'f', 'e'], 4, 'sec') # swing
         m = Measure(['c', 'd', 'e', 'f', ['g', 'f'], ['e', 'd', 'c', 'B'], 'c'], 4)
@@ -1202,7 +3097,8 @@ if __name__ == "__main__":
         # print(Chord(intervals=[0, 4, 7], base="e", duration="1/4", amplitude=0.7).rotate(1))
         ##
         ## alle meine entchen
-        alle_mein_entchen = Event.parse("c' d' e' f' g'/2 g'/2 a' a' a' a' g'/1 a' a' a' a' g'/1 f' f' f' f' e'/2 e'/2 g' g' g' g' c'/1")
+        alle_mein_entchen = Event.parse("c' d' e' f' g'/2 g'/2 a' a' a' a' g'/1 a' a' a' a' g'/1 "
+                                        "f' f' f' f' e'/2 e'/2 g' g' g' g' c'/1")
         scale = TonicScale(tonic="c'", pitches=["c", "d", "e", "f", "g", "a", "b", "c"])
         # print(scale)
         ##
@@ -1214,8 +3110,12 @@ if __name__ == "__main__":
         # beam_inference = BeamInference(5, time_series_model)
         # rand_sequence = beam_inference.sample(steps=16 - len(rand_sequence), init_history=rand_sequence)
         markov_model = MarkovModel(pitch_range())
-        # markov_model.add_corpus([[to_MIDI_pitch(pitch)] for pitch in ["c'", "d'", "e'", "f'", "g'", "a'", "b'", "c''"]])
-        markov_model.add_corpus([[to_MIDI_pitch(pitch) for pitch in ["c'", "d'", "e'", "f'", "g'", "g'", "a'", "a'", "a'", "a'", "g'", "a'", "a'", "a'", "a'", "g'", "f'", "f'", "f'", "f'", "e'", "e'", "g'", "g'", "g'", "g'", "c'"]]] * 100)
+        # markov_model.add_corpus([[to_MIDI_pitch(pitch)]
+        #                          for pitch in ["c'", "d'", "e'", "f'", "g'", "a'", "b'", "c''"]])
+        markov_model.add_corpus([[to_MIDI_pitch(pitch)
+                                  for pitch in ["c'", "d'", "e'", "f'", "g'", "g'", "a'", "a'", "a'", "a'", "g'",
+                                                "a'", "a'", "a'", "a'", "g'", "f'", "f'", "f'", "f'", "e'", "e'",
+                                                "g'", "g'", "g'", "g'", "c'"]]] * 100)
         print(markov_model._n_gram_counts)
         time_series_model = markov_model
         rand_sequence = [60, 62, 64, 65, 67]
@@ -1224,7 +3124,8 @@ if __name__ == "__main__":
             rand_sequence.append(time_series_model.sample(rand_sequence))
             # rand_sequence.append(beam_inference.sample(steps=1, init_history=rand_sequence)[-1])
             markov_model.add_history(rand_sequence)
-        for count, n_gram in reversed(sorted(zip(markov_model._n_gram_counts.values(), markov_model._n_gram_counts.keys()))):
+        for count, n_gram in reversed(sorted(zip(markov_model._n_gram_counts.values(),
+                                                 markov_model._n_gram_counts.keys()))):
             if count > 1:
                 print("{}/{}={} : {}".format(count,
                                              markov_model._count_sums[len(n_gram)],
@@ -1267,7 +3168,7 @@ if __name__ == "__main__":
             # ), repeat=2)
         ]), "X").write(file)
         ##
-        Event._indent -= 1
+        Event.context()._indent -= 1
         print("end", file=file)
         print("", file=file)
         Event.write_loops(file)
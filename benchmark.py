@@ -0,0 +1,302 @@
+"""
+Time and memory benchmarks for MusicTreequence.
+
+Run with "python benchmark.py [name ...]" (all benchmarks are run if no names are given). Workloads are scaled with
+"--scale", random generators are seeded before each benchmark, and results can be stored as JSON baseline with
+"--save <file>" and compared to one with "--baseline <file>" (see "python benchmark.py --help").
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+
+import numpy as np
+
+from MusicTreequence import *
+
+
+def measure(function, *args, **kwargs):
+    """
+    Call function and return (result, seconds, peak memory in bytes, memory still allocated afterwards in bytes).
+    """
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak, current
+
+
+def timed(function, *args, repeat=3, **kwargs):
+    """Call function 'repeat' times (without tracing memory) and return (result of the last call, fastest seconds)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+def profile(function, *args, repeat=3, **kwargs):
+    """Return (result, fastest seconds, peak memory in bytes) of calling function."""
+    _, _, peak, _ = measure(function, *args, **kwargs)
+    result, seconds = timed(function, *args, repeat=repeat, **kwargs)
+    return result, seconds, peak
+
+
+# the scale shared by the previous events (the default argument of their constructors)
+dict_event_scale = TonicScale()
+
+
+class DictEvent:
+    """
+    Stand-in for the previous (dict-backed) atomic events: same attributes, but with an own transpose list.
+    """
+
+    def __init__(self, event):
+        for cls in type(event).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if name != '__weakref__':
+                    setattr(self, name, getattr(event, name))
+        self._scale = dict_event_scale
+        self._transpose_list = []
+
+
+def atomic_events(n):
+    events = []
+    for i in range(n):
+        if i % 4 == 0:
+            events.append(Tone(60 + i % 12, duration='1/8', synth='piano'))
+        elif i % 4 == 1:
+            events.append(Chord([0, 4, 7], 60 + i % 12, duration='1/4'))
+        elif i % 4 == 2:
+            events.append(Beat(sound='kick', amplitude=0.5))
+        else:
+            events.append(Rest('1/8'))
+    return events
+
+
+def bench_atomic_memory(n=100000):
+    """memory of n atomic events with __slots__ vs. dict-backed events"""
+    events, seconds, _, current = measure(atomic_events, n)
+    _, _, _, current_dict = measure(lambda: [DictEvent(e) for e in events])
+    return {'events': n,
+            'seconds': seconds,
+            'bytes_per_event': current / n,
+            'dict_bytes_per_event': current_dict / n}
+
+
+def drum_grid(bars):
+    return Sequence([Measure([[Beat(sound='kick'), Beat(sound='hh_c')], [Beat(sound='snare'), Beat(sound='hh_c')]] * 2,
+                             extent=1)
+                     for _ in range(bars)])
+
+
+def bench_measure_grid(bars=2000):
+    """memory of a drum grid whose beats are flyweights"""
+    grid, seconds, peak, current = measure(drum_grid, bars)
+    leaves = [e for e in grid._sequence if e.is_atomic()]
+    return {'bars': bars,
+            'seconds': seconds,
+            'peak_bytes': peak,
+            'bytes_per_beat': current / len(leaves),
+            'distinct_beats': len(set(map(id, leaves)))}
+
+
+def deep_rhythm(depth, width=3):
+    """a rhythm nested 'depth' levels deep with 'width' parts on each level (all but the last one nested further)"""
+    if depth == 0:
+        return Beat(sound='hh_c')
+    return [deep_rhythm(depth - 1, width)] * (width - 1) + [Beat(sound='kick')]
+
+
+def deep_grid(bars, depth):
+    return [Measure([deep_rhythm(depth)] * 2, extent=1) for _ in range(bars)]
+
+
+def bench_measure_deep(scale=1., depth=8):
+    """construction of measures with deeply nested rhythm grids"""
+    bars = max(1, int(50 * scale))
+    grid, seconds, peak = profile(deep_grid, bars, depth)
+    return {'bars': bars,
+            'leaves': sum(len(m.get_sequence()) for m in grid),
+            'seconds': seconds,
+            'peak_bytes': peak}
+
+
+def multi_voice_piece(bars, voices):
+    """a piece of 'voices' melodies (random pitches) over a drum groove, 'bars' bars long"""
+    melodies = [Sequence([Tone(random.randrange(48, 84), duration='1/8', extent='1/{}'.format(4 * (voice + 2)))
+                          for _ in range(bars * 4 * (voice + 2))])
+                for voice in range(voices)]
+    drums = Sequence([Measure([[Beat(sound='kick'), Beat(sound='hh_c')], [Beat(sound='snare'), Beat(sound='hh_c')]] * 2,
+                              extent=1)
+                      for _ in range(bars)])
+    return Sequence([Parallel(melodies + [drums]), Tone(60, duration='1/1')])
+
+
+def write_piece(piece):
+    buffer = CodeBuffer()
+    with write_song(context=RenderContext()):
+        piece.write(buffer)
+    return buffer.getvalue()
+
+
+def bench_write(scale=1., voices=4):
+    """Sequence/Parallel.write of a long multi-voice piece"""
+    bars = max(1, int(400 * scale))
+    piece = multi_voice_piece(bars, voices)
+    code, seconds, peak = profile(write_piece, piece)
+    return {'bars': bars,
+            'voices': voices,
+            'lines': code.count("\n"),
+            'seconds': seconds,
+            'peak_bytes': peak}
+
+
+def text_score(tokens):
+    """a text score of random tokens (see Event.parse)"""
+    pitches = ["c", "d", "e", "f", "g", "a", "b", "c'", "d'", "eb'", "f#'", "g'", "a'", "bb'", "c''", "60", "67"]
+    modifiers = ["", "", "", "_", ".", "._"]
+    lengths = ["", "", "/4", "/8", "/2", "/16", "/1"]
+    choices = []
+    for _ in range(tokens):
+        kind = random.random()
+        if kind < 0.1:
+            choices.append("r" + random.choice(lengths))
+        elif kind < 0.2:
+            choices.append("b:kick" + random.choice(lengths))
+        else:
+            choices.append(random.choice(pitches) + random.choice(modifiers) + random.choice(lengths))
+    return " ".join(choices)
+
+
+def bench_parse(scale=1.):
+    """Event.parse on a large text score"""
+    tokens = max(1, int(100000 * scale))
+    score = text_score(tokens)
+    event, seconds, peak = profile(Event.parse, score)
+    return {'tokens': tokens,
+            'events': len(event.get_sequence()),
+            'seconds': seconds,
+            'peak_bytes': peak}
+
+
+# the melody of the generation scenario in the __main__ block of MusicTreequence
+alle_meine_entchen = [to_MIDI_pitch(pitch)
+                      for pitch in ["c'", "d'", "e'", "f'", "g'", "g'", "a'", "a'", "a'", "a'", "g'",
+                                    "a'", "a'", "a'", "a'", "g'", "f'", "f'", "f'", "f'", "e'", "e'",
+                                    "g'", "g'", "g'", "g'", "c'"]]
+
+
+def melody_corpus(sequences):
+    """randomly transposed and truncated variants of the scenario melody"""
+    return [[pitch + transpose for pitch in alle_meine_entchen[:random.randrange(8, len(alle_meine_entchen) + 1)]]
+            for transpose in (random.randrange(-5, 6) for _ in range(sequences))]
+
+
+def markov_model(corpus):
+    model = MarkovModel(pitch_range())
+    model.add_corpus(corpus)
+    return model
+
+
+def bench_markov_corpus(scale=1., sizes=(100, 200, 400, 800)):
+    """MarkovModel.add_corpus on growing corpora"""
+    result = {}
+    for size in sizes:
+        sequences = max(1, int(size * scale))
+        model, seconds, peak = profile(markov_model, melody_corpus(sequences))
+        result['seconds_{}'.format(size)] = seconds
+        result['peak_bytes_{}'.format(size)] = peak
+        result['n_grams_{}'.format(size)] = len(model._n_gram_counts)
+    return result
+
+
+def beam_sample(model, n_beams, steps):
+    np.random.seed(0)
+    return BeamInference(n_beams=n_beams, model=model).sample(steps=steps)
+
+
+def bench_beam_sample(scale=1., beams=(1, 4, 16, 64)):
+    """BeamInference.sample with a Markov model of the scenario melody and varying beam counts"""
+    model = markov_model([alle_meine_entchen] * 100)
+    steps = max(1, int(16 * scale))
+    result = {'steps': steps}
+    for n_beams in beams:
+        _, seconds, peak = profile(beam_sample, model, n_beams, steps, repeat=1)
+        result['seconds_{}'.format(n_beams)] = seconds
+        result['peak_bytes_{}'.format(n_beams)] = peak
+    return result
+
+
+benchmarks = {
+    'atomic_memory': bench_atomic_memory,
+    'measure_grid': bench_measure_grid,
+    'measure_deep': bench_measure_deep,
+    'write': bench_write,
+    'parse': bench_parse,
+    'markov_corpus': bench_markov_corpus,
+    'beam_sample': bench_beam_sample,
+}
+# benchmarks with workloads scaled by --scale
+scaled = {'measure_deep', 'write', 'parse', 'markov_corpus', 'beam_sample'}
+
+
+def compare(results, baseline):
+    """ratios of the times and memory peaks in results to those in baseline"""
+    ratios = {}
+    for name, result in results.items():
+        for key, value in result.items():
+            base = baseline.get(name, {}).get(key)
+            if (key.startswith('seconds') or 'bytes' in key) and base:
+                ratios.setdefault(name, {})[key] = value / base
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time and memory benchmarks for MusicTreequence")
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all of {})".format(", ".join(benchmarks)))
+    parser.add_argument("--scale", type=float, default=1., help="factor for the size of the workloads")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generators")
+    parser.add_argument("--save", help="store the results as JSON baseline in this file")
+    parser.add_argument("--baseline", help="compare the results to the JSON baseline in this file")
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error("unknown benchmark '{}'".format(name))
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline['scale'] != args.scale:
+            print("warning: baseline was run with scale {}".format(baseline['scale']), file=sys.stderr)
+    results = {}
+    for name in args.names or benchmarks:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        result = results[name] = benchmarks[name](scale=args.scale) if name in scaled else benchmarks[name]()
+        print("{}: {}".format(name, ", ".join("{}={:.6g}".format(k, v) for k, v in result.items())))
+    if baseline is not None:
+        for name, ratios in compare(results, baseline['results']).items():
+            print("{} vs. baseline: {}".format(name, ", ".join("{}={:.3f}x".format(k, v) for k, v in ratios.items())))
+    if args.save is not None:
+        with open(args.save, "w") as file:
+            json.dump({'scale': args.scale,
+                       'seed': args.seed,
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
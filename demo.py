@@ -1,6 +1,11 @@
 
+import random
+
 from MusicTreequence import *
 
+# set by render-batch, e.g. python -m MusicTreequence render-batch demo.py -p amp=0.2,0.5 -p shuffle=true -n 10
+parameters = globals().get("parameters", {})
+
 minor = (0, 3, 7)
 major = (0, 4, 7)
 minor7 = (0, 3, 7, 10)
@@ -18,12 +23,14 @@ ride = Beat(sound="ride")
 rest = Rest()
 
 base = to_MIDI_pitch("c")
-amp = 0.2
+amp = parameters.get("amp", 1.0)
 
 # scale = TonicScale(pitches=["c", "d", "e", "f", "g", "a", "b"])
 scale = TonicScale(pitches=["c", "d", "eb", "f", "g", "ab", "bb"])
-scale._tonic = base
+scale.tonic = base
 bass_line = [pitch for pitch in range(base, base + 13) if scale.is_in_scale(pitch)]
+if parameters.get("shuffle", False):
+    random.shuffle(bass_line)
 
 
 def arpeggiate(chord, base, n, extent, *args, **kwargs):
@@ -35,10 +42,11 @@ with write_song('song.rb', print_to_std_out=True):
     Event.set_beat("120bpm")
     Loop(
         Parallel([
-            arpeggiate(rotate(minor7, 8), base, 32, 8, amplitude=0.5),
-            arpeggiate(minor7, base, 16, 8),
-            arpeggiate(rotate(minor, 3), base, 16, 8),
-            Sequence([Tone(to_MIDI_pitch(pitch)-12, staccato=True, synth=":saw") for pitch in bass_line]),
+            arpeggiate(rotate(minor7, 8), base, 32, 8, amplitude=0.5 * amp),
+            arpeggiate(minor7, base, 16, 8, amplitude=amp),
+            arpeggiate(rotate(minor, 3), base, 16, 8, amplitude=amp),
+            Sequence([Tone(to_MIDI_pitch(pitch)-12, staccato=True, synth=":saw", amplitude=amp)
+                      for pitch in bass_line]),
             # Measure([
             #             [kick],
             #             [snare, hh_c],
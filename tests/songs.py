@@ -0,0 +1,41 @@
+"""Random songs for comparing what the code written with different switches plays (see sonic_pi.play)."""
+
+import random
+
+from MusicTreequence import Beat, Measure, Parallel, Rest, Sequence, Tone, Transposed
+
+
+def random_motif(rng):
+    extents = ['1/3', '1/5', '1/6', '1/8', '1/10', '1/12']
+    events = []
+    for _ in range(rng.randrange(6, 14)):
+        kind = rng.random()
+        if kind < 0.1:
+            events.append(Rest(rng.choice(extents)))
+        elif kind < 0.2:
+            events.append(Beat(sound='kick', extent=rng.choice(extents)))
+        else:
+            events.append(Tone(rng.randrange(48, 72), extent=rng.choice(extents), duration='1/16',
+                               synth=rng.choice([None, None, ':saw', ':beep'])))
+    return Sequence(events)
+
+
+def random_song(seed):
+    rng = random.Random(seed)
+    motifs = [random_motif(rng) for _ in range(3)]
+    parts = []
+    for _ in range(8):
+        kind = rng.random()
+        if kind < 0.4:
+            parts.append(Parallel([rng.choice(motifs), rng.choice(motifs)]))
+        elif kind < 0.6:
+            parts.append(Transposed(rng.choice(motifs), rng.randrange(-3, 4)))
+        elif kind < 0.8:
+            parts.append(Measure([[Beat(sound='kick'), Beat(sound='hh_c')]] * 4, extent=rng.choice([1, 2])))
+        else:
+            parts.append(rng.choice(motifs))
+    # voices written as threads, followed by rests (the written code then has consecutive and zero sleeps)
+    grace_notes = Parallel([Tone(rng.randrange(48, 72), extent=0, duration='1/16') for _ in range(2)], threads=True)
+    threads = Sequence([Parallel([rng.choice(motifs), Transposed(rng.choice(motifs), 2)], threads=True),
+                        Rest(rng.choice(['1/4', '1/6'])), grace_notes, Rest('1/8')])
+    return Sequence([Sequence(parts), Parallel([Sequence(parts), rng.choice(motifs)]), threads, Sequence(parts)])
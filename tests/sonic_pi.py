@@ -0,0 +1,68 @@
+"""A minimal interpreter for the Sonic Pi code written by MusicTreequence, used to compare what songs play."""
+
+import re
+
+_block = re.compile(r"^(\d+\.times do|in_thread do|while .*|def .*)$")
+
+
+def blocks(lines):
+    """parse indented code lines into a list of (line, body) pairs (body is None for single lines)"""
+    parsed = []
+    stack = [parsed]
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#") or line.startswith("puts"):
+            continue
+        if line == "end":
+            stack.pop()
+        elif _block.match(line):
+            body = []
+            stack[-1].append((line, body))
+            stack.append(body)
+        else:
+            stack[-1].append((line, None))
+    return parsed
+
+
+def play(code, digits=6):
+    """
+    Run the function 'song' of the code and return the sorted list of (time, kind, pitch or sample, synth, options)
+    it plays (loops with loop_test are run once) and the time at its end.
+    """
+    functions = {}
+    top = blocks(line for line in code.splitlines() if not line.strip().startswith(("loops", "].to_set", "return",
+                                                                                     "'")))
+    for line, body in top:
+        if body is not None and line.startswith("def "):
+            functions[line.split()[1]] = body
+    events = []
+
+    def run(body, time, synth):
+        for line, inner in body:
+            if inner is not None:
+                if line.startswith("in_thread"):
+                    run(inner, time, synth)
+                elif line.startswith("while"):
+                    time, synth = run(inner, time, synth)
+                else:
+                    for _ in range(int(line.split(".")[0])):
+                        time, synth = run(inner, time, synth)
+            elif line.startswith("sleep "):
+                time += float(line.split()[1])
+            elif line.startswith("use_synth "):
+                synth = line.split()[1]
+            elif line.startswith("play_chord "):
+                pitches, options = re.match(r"play_chord \[([^\]]*)\], (.*)$", line).groups()
+                for pitch in pitches.split(","):
+                    events.append((round(time, digits), "play", float(pitch), synth, options))
+            elif line.startswith("play "):
+                pitch, options = line[len("play "):].split(", ", 1)
+                events.append((round(time, digits), "play", float(pitch), synth, options))
+            elif line.startswith("sample "):
+                events.append((round(time, digits), "sample", line[len("sample "):], None, ""))
+            else:
+                time, synth = run(functions[line.split()[0]], time, synth)
+        return time, synth
+
+    end, _ = run(functions["song"], 0., None)
+    return sorted(events, key=lambda event: tuple(map(str, event))), round(end, digits)
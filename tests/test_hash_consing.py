@@ -0,0 +1,65 @@
+import pytest
+
+from MusicTreequence import Event, Sequence, Timeline, TonicScale, Tone, Transposed, write_song
+
+from songs import random_song
+from sonic_pi import play
+
+
+def render(song, hash_consing, file):
+    Event.set_hash_consing(hash_consing)
+    try:
+        with write_song(str(file)):
+            song.write()
+    finally:
+        Event.set_hash_consing(True)
+    return file.read_text()
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_hash_consing_plays_the_same(seed, tmp_path):
+    song = random_song(seed)
+    shared = render(song, True, tmp_path / "shared.rb")
+    inline = render(song, False, tmp_path / "inline.rb")
+    assert "shared_" in shared
+    assert "sleep 0.0\n" not in inline
+    assert play(shared) == play(inline)
+
+
+def test_shared_parts_are_compiled_once(tmp_path, monkeypatch):
+    compiled = []
+    compile_sequence = Timeline.compile_sequence
+
+    def counting(events, transpose_list=()):
+        compiled.append(len(events))
+        return compile_sequence(events, transpose_list)
+
+    monkeypatch.setattr(Timeline, "compile_sequence", staticmethod(counting))
+    # equal motifs made of different events are shared as well
+    motifs = [Sequence([Tone(60 + i % 8) for i in range(8)]) for _ in range(10)]
+    code = render(Sequence([Sequence([motif, Tone(72)]) for motif in motifs]), True, tmp_path / "song.rb")
+    assert compiled == [9]
+    assert code.count("def function_shared_") == 1
+
+
+def test_tonic_changes_between_writes(tmp_path):
+    scale = TonicScale(intervals='major')
+    motif = Transposed(Sequence([Tone(60 + i) for i in range(8)]), 2, scale=scale)
+    song = Sequence([motif, motif])
+
+    def render_twice(hash_consing, file):
+        Event.set_hash_consing(hash_consing)
+        try:
+            with write_song(str(file)):
+                scale.tonic = "c'"
+                song.write()
+                scale.tonic = "d'"
+                song.write()
+        finally:
+            Event.set_hash_consing(True)
+            scale.tonic = "c'"
+        return file.read_text()
+
+    shared = render_twice(True, tmp_path / "shared.rb")
+    assert shared.count("def function_shared_") == 2
+    assert play(shared) == play(render_twice(False, tmp_path / "inline.rb"))
@@ -0,0 +1,63 @@
+import struct
+
+from MusicTreequence import Beat, Parallel, Rest, Sequence, Sound, Tone, write_midi
+
+
+def read_midi(path):
+    """(ticks per beat, [(tick, status, data...), ...]) of a format 0 Standard MIDI File"""
+    with open(path, "rb") as file:
+        content = file.read()
+    assert content[:4] == b"MThd"
+    length, midi_format, tracks, ticks_per_beat = struct.unpack(">ihhh", content[4:14])
+    assert (length, midi_format, tracks) == (6, 0, 1)
+    assert content[14:18] == b"MTrk"
+    end = 22 + struct.unpack(">i", content[18:22])[0]
+    assert end == len(content)
+    events = []
+    position, tick = 22, 0
+    while position < end:
+        delta = 0
+        while True:
+            byte = content[position]
+            position += 1
+            delta = delta << 7 | byte & 0x7f
+            if byte < 0x80:
+                break
+        tick += delta
+        status = content[position]
+        if status == 0xff:
+            meta, length = content[position + 1:position + 3]
+            events.append((tick, status, meta, content[position + 3:position + 3 + length]))
+            position += 3 + length
+        else:
+            events.append((tick, status) + tuple(content[position + 1:position + 3]))
+            position += 3
+    return ticks_per_beat, events
+
+
+def test_notes_are_decoded(tmp_path):
+    path = str(tmp_path / "song.mid")
+    write_midi(Sequence([Tone(60), Parallel([Tone(64), Tone(67)])]), path)
+    ticks_per_beat, events = read_midi(path)
+    notes = [event for event in events if event[1] != 0xff]
+    assert notes == [(0, 0x90, 60, 100), (480, 0x80, 60, 0),
+                     (480, 0x90, 64, 100), (480, 0x90, 67, 100), (960, 0x80, 64, 0), (960, 0x80, 67, 0)]
+    assert events[0][1:3] == (0xff, 0x51)
+    assert events[-1][1:3] == (0xff, 0x2f)
+
+
+def test_track_ends_at_extent(tmp_path):
+    path = str(tmp_path / "song.mid")
+    write_midi(Sequence([Tone(60), Rest(), Rest()]), path)
+    ticks_per_beat, events = read_midi(path)
+    assert events[-2] == (ticks_per_beat, 0x80, 60, 0)
+    assert events[-1] == (3 * ticks_per_beat, 0xff, 0x2f, b"")
+
+
+def test_sounds_are_drums(tmp_path):
+    path = str(tmp_path / "song.mid")
+    write_midi(Sequence([Beat(sound="kick"), Sound(":drum_snare_soft", add_code=", rate: 2"), Sound(":unknown")]),
+               path)
+    ticks_per_beat, events = read_midi(path)
+    notes = [event for event in events if event[1] & 0xf0 == 0x90]
+    assert notes == [(0, 0x99, 36, 100), (ticks_per_beat, 0x99, 38, 100)]
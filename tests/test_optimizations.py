@@ -0,0 +1,55 @@
+from copy import copy
+
+import pytest
+
+from MusicTreequence import Event, write_song
+
+from songs import random_song
+from sonic_pi import play
+
+peephole_passes = ("drop_zero_sleeps", "merge_sleeps", "drop_repeated_synths", "play_chords")
+
+
+def render(song, file, hash_consing=True, max_period=64, **passes):
+    settings = {name: copy(getattr(Event, name)) for name in Event._settings}
+    try:
+        Event.set_hash_consing(hash_consing)
+        Event.set_optimizations(**passes)
+        Event._repetition_max_period = max_period
+        with write_song(str(file)):
+            song.write()
+    finally:
+        for name, value in settings.items():
+            setattr(Event, name, value)
+    return file.read_text()
+
+
+@pytest.mark.parametrize("hash_consing", [True, False])
+@pytest.mark.parametrize("seed", range(20))
+def test_peephole_passes_play_the_same(seed, hash_consing, tmp_path):
+    song = random_song(seed)
+    plain = render(song, tmp_path / "plain.rb", hash_consing, enabled=False)
+    expected = play(plain)
+    for name in peephole_passes:
+        code = render(song, tmp_path / "{}.rb".format(name), hash_consing, enabled=False, **{name: True})
+        assert play(code) == expected, name
+    optimized = render(song, tmp_path / "optimized.rb", hash_consing, compress_repetitions=False)
+    assert optimized.count("\n") < plain.count("\n")
+    assert play(optimized) == expected
+
+
+@pytest.mark.parametrize("max_period", [1, 4, 64])
+@pytest.mark.parametrize("seed", range(20))
+def test_repetition_compression_plays_the_same(seed, max_period, tmp_path):
+    song = random_song(seed)
+    for hash_consing in (True, False):
+        plain = render(song, tmp_path / "plain.rb", hash_consing, compress_repetitions=False)
+        compressed = render(song, tmp_path / "compressed.rb", hash_consing, max_period=max_period)
+        assert play(compressed) == play(plain)
+        # all passes on and off play the same as well
+        assert play(compressed) == play(render(song, tmp_path / "none.rb", hash_consing, enabled=False))
+
+
+def test_repetitions_are_compressed(tmp_path):
+    compressed = [render(random_song(seed), tmp_path / "song.rb") for seed in range(20)]
+    assert sum(".times do" in code for code in compressed) > 10
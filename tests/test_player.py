@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+import pytest
+
+from MusicTreequence import Beat, OSCReceiver, Parallel, Player, RenderContext, Sequence, Sound, Timeline, Tone
+
+
+def timeline(beat=0.05):
+    with RenderContext(beat=beat).activate():
+        chord = Parallel([Tone(64), Beat(sound="kick"), Sound(":bd_haus", add_code=", rate: 2")])
+        return Timeline.compile(Sequence([Tone(60, synth=":saw"), chord, Tone(67, synth=":saw", amplitude=0.5)]))
+
+
+def test_player_sends_timed_bundles():
+    lookahead = 0.05
+    with OSCReceiver() as receiver, Player(*receiver.get_address(), lookahead=lookahead) as player:
+        start = time.time() + lookahead
+        asyncio.run(player.play(timeline(), start=start))
+        receiver.wait(5)
+        messages = receiver.get_timed_messages()
+        statistics = player.get_statistics()
+    assert [(address, args) for arrival, timestamp, address, args in messages] == [
+        ("/music_treequence/play", [60, pytest.approx(0.05), 1.0, "saw"]),
+        ("/music_treequence/play", [64, pytest.approx(0.05), 1.0, ""]),
+        ("/music_treequence/sample", ["drum_bass_soft", 1.0]),
+        ("/music_treequence/sample", ["bd_haus", 1.0]),
+        ("/music_treequence/play", [67, pytest.approx(0.05), 0.5, "saw"])]
+    # one bundle per onset, time-stamped with the onset
+    timestamps = [timestamp - start for arrival, timestamp, address, args in messages]
+    assert timestamps == pytest.approx([0., 0.05, 0.05, 0.05, 0.1], abs=1e-6)
+    # bundles are sent in order, none earlier than 'lookahead' seconds before it is due
+    arrivals = [arrival for arrival, timestamp, address, args in messages]
+    assert arrivals[0] < arrivals[1] == arrivals[2] == arrivals[3] < arrivals[4]
+    for arrival, timestamp, address, args in messages:
+        assert arrival >= timestamp - lookahead - 0.005
+    assert statistics["bundles"] == 3 and statistics["messages"] == 5
+
+
+def test_player_bundles_are_scheduled_in_order():
+    with Player(lookahead=0.1) as player:
+        bundles = list(player.bundles(timeline(beat=1), start=100.))
+    assert [send_time for send_time, bundle, n_messages in bundles] == pytest.approx([99.9, 100.9, 101.9])
+    assert [n_messages for send_time, bundle, n_messages in bundles] == [1, 3, 1]
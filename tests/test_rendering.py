@@ -0,0 +1,132 @@
+import sys
+import threading
+import time
+
+from MusicTreequence import (CodeBuffer, Event, Parallel, RenderContext, Sequence, Timeline, TonicScale, Tone,
+                             Transposed, write_song)
+
+# one motif shared by all songs (and several times within each song)
+motif = Sequence([Tone(60 + i % 5, duration='1/16', extent='1/16') for i in range(16)])
+
+
+def song(transpose):
+    return Sequence([Parallel([motif, Transposed(motif, transpose)], threads=True),
+                     Transposed(Parallel([motif, Sequence([motif], transpose=transpose)], threads=True), -transpose),
+                     Sequence([motif, Parallel([motif, motif], threads=True)], transpose=transpose)] * 4)
+
+
+def render(transpose, context=None, barrier=None):
+    buffer = CodeBuffer()
+    with write_song(context=context):
+        if barrier is not None:
+            barrier.wait()
+        song(transpose).write(buffer)
+    return buffer.getvalue()
+
+
+def test_concurrent_rendering_with_shared_nodes():
+    transposes = [1, 2, 3, 5, 7, 12]
+    expected = [render(transpose) for transpose in transposes]
+    for _ in range(5):
+        results = [None] * len(transposes)
+        barrier = threading.Barrier(len(transposes))
+
+        def run(idx):
+            results[idx] = render(transposes[idx], context=RenderContext(), barrier=barrier)
+
+        threads = [threading.Thread(target=run, args=(idx,)) for idx in range(len(transposes))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == expected
+
+
+def test_transposition_does_not_modify_shared_nodes():
+    before = render(3)
+    render(4)
+    assert render(3) == before
+    assert "play 63" in render(3)
+
+
+def test_extent_cache_counters_are_per_context():
+    def run(context, barrier=None):
+        with context.activate():
+            if barrier is not None:
+                barrier.wait()
+            for _ in range(1000):
+                Sequence([motif, motif]).extent()
+
+    expected = RenderContext()
+    run(expected)
+    expected = Event.extent_cache_info(context=expected)
+    assert expected["hits"] > 0 and expected["misses"] > 0
+    contexts = [RenderContext() for _ in range(4)]
+    barrier = threading.Barrier(len(contexts))
+    threads = [threading.Thread(target=run, args=(context, barrier)) for context in contexts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for context in contexts:
+        info = Event.extent_cache_info(context=context)
+        # shared nodes cached in another context miss again, but no lookup is lost or counted elsewhere
+        assert info["hits"] + info["misses"] == expected["hits"] + expected["misses"]
+        assert info["misses"] >= expected["misses"]
+        assert info["generation"] == context._extent_generation
+    contexts[0].reset()
+    info = Event.extent_cache_info(context=contexts[0])
+    assert info["hits"] == info["misses"] == 0
+
+
+def scale_pitches(event, context):
+    with context.activate():
+        return Timeline.compile(event).get_records()['pitch'].tolist()
+
+
+def test_transposition_tables_are_per_context():
+    scale = TonicScale(tonic="c'", intervals="major")
+    event = Sequence([Tone(60), Tone(64)], transpose=1, scale=scale)
+    contexts = [RenderContext(), RenderContext()]
+    assert [scale_pitches(event, context) for context in contexts] == [[62, 65], [62, 65]]
+    contexts[0].reset()
+    assert not contexts[0]._transposition_tables and contexts[1]._transposition_tables
+    # a new tonic is picked up by the tables cached in all contexts
+    scale.tonic = "d'"
+    assert [scale_pitches(event, context) for context in contexts] == [[61, 66], [61, 66]]
+
+
+def test_tonic_changes_while_rendering():
+    scales = [TonicScale(tonic=tonic, intervals="minor") for tonic in ("c'", "d'", "e'")]
+    errors = []
+    stop = threading.Event()
+
+    def run():
+        try:
+            context = RenderContext()
+            while not stop.is_set():
+                context.reset()
+                # many distinct chains of transpositions
+                for transpose in range(1, 40):
+                    parts = [Transposed(motif, inner, scale=scales[inner % 3]) for inner in range(-3, 4)]
+                    scale_pitches(Sequence(parts, transpose=transpose, scale=scales[transpose % 3]), context)
+        except Exception as error:
+            errors.append(error)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        end = time.monotonic() + 0.5
+        idx = 0
+        while time.monotonic() < end:
+            scales[idx % 3].tonic = 60 + idx % 12
+            idx += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
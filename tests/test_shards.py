@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from MusicTreequence import Loop, Sequence, Tone, write_song
+
+
+def write_sharded(file, shard_dir=None, symbols=("a", "b")):
+    with write_song(file, shards=True, shard_dir=shard_dir):
+        for symbol in symbols:
+            Loop(Sequence([Tone(60), Tone(62)]), symbol=symbol, repeat=2).write()
+
+
+def test_shards_are_written(tmp_path):
+    song = tmp_path / "song.rb"
+    write_sharded(str(song))
+    shard_dir = tmp_path / "song_shards"
+    assert sorted(os.listdir(shard_dir)) == [".music_treequence_shards", "function_a.rb", "function_b.rb",
+                                             "loop_test.rb", "song.rb"]
+    assert str(shard_dir / "function_a.rb") in song.read_text()
+
+
+def test_only_stale_shards_are_removed(tmp_path):
+    song = tmp_path / "song.rb"
+    shard_dir = tmp_path / "shards"
+    shard_dir.mkdir()
+    (shard_dir / "other.rb").write_text("# not a shard\n")
+    write_sharded(str(song), str(shard_dir))
+    write_sharded(str(song), str(shard_dir), symbols=("a",))
+    names = set(os.listdir(shard_dir))
+    assert "function_b.rb" not in names
+    assert {"function_a.rb", "other.rb"} <= names
+    assert (shard_dir / "other.rb").read_text() == "# not a shard\n"
+
+
+def test_shard_dir_must_not_contain_song(tmp_path):
+    (tmp_path / "main.rb").write_text("# user file\n")
+    with pytest.raises(UserWarning):
+        write_sharded(str(tmp_path / "song.rb"), str(tmp_path))
+    assert os.listdir(tmp_path) == ["main.rb"]
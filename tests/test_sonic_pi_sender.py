@@ -0,0 +1,63 @@
+import re
+
+from MusicTreequence import OSCReceiver, SonicPi
+
+# index and Ruby string literal of a chunk assigned in the code sent by SonicPi
+chunk_assignment = re.compile(r"\[(\d+)\] = '((?:[^'\\]|\\.)*)'", re.S)
+
+
+def reassemble(messages):
+    """the code sent by SonicPi as one message or in chunks"""
+    if len(messages) == 1:
+        return messages[0][2][1]
+    chunks = {}
+    for arrival, address, args in messages:
+        idx, literal = chunk_assignment.search(args[1]).groups()
+        chunks[int(idx)] = re.sub(r"\\(.)", r"\1", literal, flags=re.S)
+    assert sorted(chunks) == list(range(len(messages)))
+    return "".join(chunks[idx] for idx in range(len(chunks)))
+
+
+def song_code(lines):
+    return "".join("play {}, amp: 0.5 # it's a \\ 'note' ö\nsleep 0.25\n".format(60 + idx % 12)
+                   for idx in range(lines))
+
+
+def test_small_code_is_sent_in_one_message():
+    code = song_code(3)
+    with OSCReceiver() as receiver, SonicPi(*receiver.get_address(), client="test") as sonic_pi:
+        sonic_pi.run_code(code)
+        assert receiver.wait(1) == [(receiver.get_messages()[0][0], "/run-code", ["test", code])]
+
+
+def test_large_code_is_sent_in_chunks():
+    code = song_code(200)
+    with OSCReceiver() as receiver, SonicPi(*receiver.get_address(), token="secret", chunk_size=1000) as sonic_pi:
+        sonic_pi.run_code(code)
+        n_chunks = -(-len(code) // 1000)
+        assert n_chunks > 1
+        messages = receiver.wait(n_chunks)
+        assert len(messages) == n_chunks
+        assert all(address == "/run-code" and args[0] == "secret" for arrival, address, args in messages)
+        assert "eval" in messages[-1][2][1]
+        assert reassemble(messages) == code
+
+
+def test_default_chunks_fit_into_packets():
+    code = song_code(5000)
+    with OSCReceiver() as receiver, SonicPi(*receiver.get_address(), address="/test") as sonic_pi:
+        n_packets = len(sonic_pi.packets(code))
+        sonic_pi.run_code(code)
+        messages = receiver.wait(n_packets)
+        assert len(messages) == n_packets > 1
+        assert {address for arrival, address, args in messages} == {"/test"}
+        assert reassemble(messages) == code
+
+
+def test_unchanged_code_is_not_sent_again():
+    code = song_code(3)
+    with OSCReceiver() as receiver, SonicPi(*receiver.get_address()) as sonic_pi:
+        assert sonic_pi.run_code(code, if_changed=True)
+        assert not sonic_pi.run_code(code, if_changed=True)
+        assert sonic_pi.run_code(code + "sleep 1\n", if_changed=True)
+        assert [args[1] for arrival, address, args in receiver.wait(2)] == [code, code + "sleep 1\n"]
@@ -0,0 +1,21 @@
+from MusicTreequence import Event, run_watched
+
+script = """
+from MusicTreequence import *
+{switch}
+with write_song({song!r}):
+    Parallel([Sequence([Tone(60)] * 3), Sequence([Tone(64)] * 5)]).write()
+"""
+
+
+def test_switches_do_not_survive_reruns(tmp_path):
+    path = tmp_path / "song.py"
+    song = tmp_path / "song.rb"
+    path.write_text(script.format(switch="Event.set_parallel_threads()\nEvent.set_hash_consing(False)", song=str(song)))
+    run_watched(str(path))
+    assert "in_thread" in song.read_text()
+    assert Event._parallel_threads is False and Event._hash_consing is True
+    path.write_text(script.format(switch="", song=str(song)))
+    run_watched(str(path))
+    assert "in_thread" not in song.read_text()
+    assert Event._write_if_changed is False